@@ -3,4 +3,5 @@ import os
 
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 DATA_ROOT = os.path.join(_ROOT, 'data')
-CSV_ROOT = os.path.join(_ROOT, 'csv')
\ No newline at end of file
+CSV_ROOT = os.path.join(_ROOT, 'csv')
+PROFILE_ROOT = os.path.join(_ROOT, 'profiles')
\ No newline at end of file
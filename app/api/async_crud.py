@@ -0,0 +1,55 @@
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.metrics import timed_query
+
+from .models import User, LiveSummarySection
+from .schemas import User as UserSchema
+from .cache import MISSING
+from .crud import user_cache, REVIEWLIST_SQL, SCREENLIST_COLUMNS, screenlist_query, screenlist_page
+
+# async versions of the read queries in crud.py behind the hot read endpoints,
+# same SQL, run on app.database.get_async_engine()
+
+
+@timed_query
+async def get_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    result = await db.execute(select(User).filter_by(id=user_id))
+    return result.scalars().first()
+
+
+async def get_cached_user(db: AsyncSession, user_id: int) -> Optional[UserSchema]:
+    # shares crud.user_cache with the sync path
+    user = user_cache.get(user_id)
+    if user is MISSING:
+        db_user = await get_user(db, user_id)
+        if db_user is None:
+            return None
+        user = UserSchema.from_orm(db_user)
+        user_cache.set(user_id, user)
+    return user
+
+
+@timed_query
+async def get_reviewlist_from_db(db: AsyncSession, user_id: str) -> list:
+    result = await db.execute(text(REVIEWLIST_SQL), {"user_id": user_id})
+    return [dict(r) for r in result.mappings()]
+
+
+@timed_query
+async def get_screenlist_from_db(db: AsyncSession, revid: str, user_id: str, after: str = None,
+                                 limit: int = None, fields: List[str] = None) -> tuple:
+    fields = list(SCREENLIST_COLUMNS) if fields is None else fields
+    result = await db.execute(screenlist_query(fields),
+                              {"revid": revid, "user_id": user_id, "after": after,
+                               "limit": None if limit is None else limit + 1})
+    return screenlist_page([dict(r) for r in result.mappings()], fields, limit)
+
+
+@timed_query
+async def get_live_summary_from_db(db: AsyncSession, revid: str) -> List[LiveSummarySection]:
+    result = await db.execute(select(LiveSummarySection).filter_by(revid=revid))
+    return result.scalars().all()
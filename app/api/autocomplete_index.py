@@ -0,0 +1,108 @@
+#
+#   precomputed autocomplete results for every prefix of the PICO/MeSH trie
+#
+#   build from the trie pickle with:
+#       python -m app.api.autocomplete_index [pico_cui_autocompleter.pck] [pico_cui_autocompleter.idx]
+#
+
+import json
+import os
+import pickle
+import sys
+from functools import lru_cache
+
+import app
+from app.mmap_index import MmapIndex, write_index
+
+INDEX_PATH = os.path.join(app.DATA_ROOT, 'pico_cui_autocompleter.idx')
+PICKLE_PATH = os.path.join(app.DATA_ROOT, 'pico_cui_autocompleter.pck')
+
+MIN_CHAR = 3
+MAX_RETURN = 5
+# hot prefixes kept decoded per worker
+CACHE_SIZE = 4096
+
+_index = None
+
+
+def lookup_trie(pico_trie, q) -> list:
+    """
+    the autocomplete results for q straight from the trie, used to build the
+    index (and as the fallback when no index has been built)
+    """
+    substr = q
+    if substr is None or not pico_trie.has_subtrie(substr):
+        return []
+
+    matches = pico_trie.itervalues(prefix=substr)
+
+    def flat_list(l):
+        return [item for sublist in l for item in sublist]
+
+    def dedupe(l):
+        encountered = set()
+        out = []
+        for r in l:
+            if r['cui_pico_display'] not in encountered:
+                encountered.add(r['cui_pico_display'])
+                out.append(r)
+        return out
+
+    if len(substr) < MIN_CHAR:
+        # for short ones just return first 5
+        return dedupe(flat_list([r for _, r in zip(range(MAX_RETURN), matches)]))
+    else:
+        # where we have enough chars, process and get top ranked
+        return sorted(dedupe(flat_list(matches)), key=lambda x: x['count'], reverse=True)[:MAX_RETURN]
+
+
+def load_trie(path=PICKLE_PATH):
+    print("loading autocompleter")
+    with open(path, 'rb') as f:
+        pico_trie = pickle.load(f)
+    print("done loading autocompleter")
+    return pico_trie
+
+
+def get_index():
+    global _index
+    if _index is None:
+        if os.path.exists(INDEX_PATH):
+            _index = MmapIndex(INDEX_PATH)
+        else:
+            print(f"{INDEX_PATH} not found, falling back to the trie (build it with python -m app.api.autocomplete_index)")
+            _index = load_trie()
+    return _index
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _lookup(q) -> bytes:
+    # cached as encoded JSON, which no caller can modify
+    index = get_index()
+    if not isinstance(index, MmapIndex):
+        return json.dumps(lookup_trie(index, q)).encode('utf-8')
+    if q is None:
+        return b'[]'
+    value = index.get(q)
+    return b'[]' if value is None else value
+
+
+def autocomplete(q) -> list:
+    # decoded on every call, so each caller gets a list of its own
+    return json.loads(_lookup(q))
+
+
+def build(pickle_path=PICKLE_PATH, index_path=INDEX_PATH):
+    """
+    every prefix of every key, '' included, mapped to its deduped top results
+    as JSON (the total work is the summed key length, not prefixes x matches)
+    """
+    pico_trie = load_trie(pickle_path)
+    prefixes = {key[:i] for key in pico_trie.iterkeys() for i in range(len(key) + 1)}
+    write_index(index_path, ((prefix, json.dumps(lookup_trie(pico_trie, prefix)).encode('utf-8'))
+                             for prefix in prefixes))
+    print(f"wrote {len(prefixes)} prefixes to {index_path}")
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:3])
@@ -1,39 +1,85 @@
 import app
 from typing import List, Optional
 import pandas as pd
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
+from app.metrics import SUMMARIZER_SECONDS, timed_query
 
-from .schemas import GithubUser, LiveSummarySections
+from .schemas import GithubUser, LiveSummarySections, User as UserSchema
+from .cache import TTLCache, MISSING
+from app.bulk import copy_into
+from .storage import get_storage
 from .models import User, RevMeta, LiveSummarySection, InitScreenRecord, Permission
 from .helpers import generate_rev_id, get_api_input_format
+from . import autocomplete_index
 
 import os
-import pickle
 import csv
-
-# For Loading autocompleter data
-print("loading autocompleter")
-with open(os.path.join(app.DATA_ROOT, 'pico_cui_autocompleter.pck'), 'rb') as f:
-    pico_trie = pickle.load(f)
-print("done loading autocompleter")
+import json
+import zlib
+from contextlib import closing
 
 
+@timed_query
 def get_user(db: Session, user_id: int) -> Optional[User]:
     print("get user")
     return db.query(User).filter_by(id=user_id).first()
 
 
+# uploaded init_screen CSVs are parsed and COPYed this many rows at a time
+INIT_SCREEN_CHUNKSIZE = 5000
+INIT_SCREEN_COLUMNS = ['pmid', 'ti', 'ab', 'decision']
+# the screening decisions the model is trained on, see get_training_data
+INIT_SCREEN_DECISIONS = ('Include', 'Exclude')
+
+# users and their review permissions, looked up on every authenticated request
+USER_CACHE_TTL = 60
+user_cache = TTLCache(USER_CACHE_TTL)
+permission_cache = TTLCache(USER_CACHE_TTL)
+# a login's permissions are re-read at most once per interval however many
+# refreshes are asked for, so repeated unauthorised requests stay cheap
+PERMISSION_REFRESH_INTERVAL = 5
+permission_refreshed = TTLCache(PERMISSION_REFRESH_INTERVAL)
+
+
+def get_cached_user(db: Session, user_id: int) -> Optional[UserSchema]:
+    user = user_cache.get(user_id)
+    if user is MISSING:
+        db_user = get_user(db, user_id)
+        if db_user is None:
+            return None
+        user = UserSchema.from_orm(db_user)
+        user_cache.set(user_id, user)
+    return user
+
+
+def get_user_revids(db: Session, login: str, refresh: bool = False) -> frozenset:
+    # refresh=True skips the cache, e.g. for a review just created by another
+    # worker, unless it was already refreshed in the last PERMISSION_REFRESH_INTERVAL
+    if refresh and permission_refreshed.get(login) is not MISSING:
+        refresh = False
+    revids = MISSING if refresh else permission_cache.get(login)
+    if revids is MISSING:
+        revids = frozenset(p.revid for p in db.query(Permission).filter_by(login=login).all())
+        permission_cache.set(login, revids)
+        permission_refreshed.set(login, True)
+    return revids
+
+
+@timed_query
 def get_user_by_login(db: Session, login: str) -> Optional[User]:
     print("get user by login")
     return db.query(User).filter_by(login=login).first()
 
 
+@timed_query
 def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[User]:
     print("getting users")
     return db.query(User).offset(skip).limit(limit).all()
 
 
+@timed_query
 def create_user(db: Session, github_user: GithubUser) -> User:
     user = User(
         login=github_user.login,
@@ -44,66 +90,195 @@ def create_user(db: Session, github_user: GithubUser) -> User:
     db.add(user)
     db.commit()
     db.refresh(user)
+    user_cache.invalidate(user.id)
     return user
 
+@timed_query
 def update_user(db: Session, user_id: int, new_user_info: User) -> User:
     user_from_db = db.query(User).filter_by(id=user_id).first()
     user_from_db.name = new_user_info.name
     user_from_db.email = new_user_info.email
     db.commit()
     db.refresh(user_from_db)
+    user_cache.invalidate(user_id)
     return user_from_db
 
+# one aggregate query for the dashboard: every review the user has access
+# to, with the number of abstracts still waiting for a decision
+REVIEWLIST_SQL = """select revmeta.revid, revmeta.title, revmeta.last_updated,
+            count(pm.pmid) as num_abstracts_to_screen
+            from permissions
+            join revmeta on revmeta.revid=permissions.revid
+            left join (manscreen as ms
+                join pubmed as pm on pm.pmid=ms.pmid
+                join pubmed_annotations as pa on pa.pmid=pm.pmid)
+            on ms.revid=permissions.revid and ms.decision is null
+            where permissions.login=:user_id
+            group by revmeta.revid, revmeta.title, revmeta.last_updated
+            order by revmeta.revid;"""
+
+
+@timed_query
 def get_reviewlist_from_db(engine, user_id: str) -> list:
-    reviewmeta = pd.read_sql("select revmeta.revid, revmeta.title, revmeta.last_updated from revmeta, permissions where permissions.login=%(user_id)s and revmeta.revid=permissions.revid ORDER BY permissions.revid;",
+    # read_sql_query: read_sql would first ask the catalog whether the
+    # query is a table name, a second round trip
+    reviewlist = pd.read_sql_query(text(REVIEWLIST_SQL),
                              engine,
                              params = {"user_id": user_id})
-    revids = tuple(r.revid for (i, r) in reviewmeta.iterrows())
-
-    # Including the number of abstracts for each review for the dashboard
-
-    if len(revids) > 1:
-        query = f"""
-        select (select count(pm.pmid) from manscreen as ms, pubmed as pm, pubmed_annotations as pa, permissions p
-        where permissions.revid=p.revid and p.login='{user_id}' and decision is null
-        and pm.pmid=ms.pmid and pm.pmid=pa.pmid and permissions.revid=ms.revid) as num_abstracts_to_screen
-        from permissions
-        where permissions.revid IN {revids}
-        group by permissions.revid order by permissions.revid;
-        """
-    else:
-        query = f"""
-        select (select count(pm.pmid) from manscreen as ms, pubmed as pm, pubmed_annotations as pa, permissions p
-        where permissions.revid=p.revid and p.login='{user_id}' and decision is null
-        and pm.pmid=ms.pmid and pm.pmid=pa.pmid and permissions.revid=ms.revid) as num_abstracts_to_screen
-        from permissions
-        where permissions.revid='{revids[0]}'
-        group by permissions.revid order by permissions.revid;
-        """
-    num_abstracts_to_screen = pd.read_sql_query(query, engine)
-    reviewmeta['num_abstracts_to_screen'] = num_abstracts_to_screen
-
-    return reviewmeta.to_dict('records')
+
+    return reviewlist.to_dict('records')
     
-def get_screenlist_from_db(engine, revid: str, user_id: str) -> list:
-    toscreen = pd.read_sql("""select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
-            pm.pm_data->'journal' as journal, pa.num_randomized, pa.prob_low_rob, pa.effect from manscreen as ms, pubmed as pm,
-            pubmed_annotations as pa, permissions where permissions.revid=%(revid)s and permissions.login=%(user_id)s
-            and decision is null and pm.pmid=ms.pmid and pm.pmid=pa.pmid and permissions.revid=ms.revid;""",
-            engine, params={"revid": revid, "user_id": user_id})
-    cites = [get_cite(r.authors, r.journal, r.year) for (i, r) in toscreen.iterrows()]
-    toscreen.drop("authors", axis=1, inplace=True)
-    toscreen['citation'] = cites
-    return toscreen.to_dict('records')
-
-def get_review_included_studies_df(db, revid: str) -> pd.DataFrame:
-    included_studies_df = pd.read_sql("""select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
+# screening queue paging, ordered (and resumed) by pmid; without a limit
+# the whole queue is returned, as before paging was added
+SCREENLIST_MAX_PAGE_SIZE = 1000
+
+# fields= projection of the screening queue -> the columns it needs
+SCREENLIST_COLUMNS = {
+    "pmid": ["pm.pmid"],
+    "year": ["pm.year"],
+    "ti": ["pm.ti"],
+    "ab": ["pm.ab"],
+    "journal": ["pm.pm_data->'journal' as journal"],
+    "citation": ["pm.year", "pm.pm_data->'authors' as authors", "pm.pm_data->'journal' as journal"],
+    "num_randomized": ["pa.num_randomized"],
+    "prob_low_rob": ["pa.prob_low_rob"],
+    "effect": ["pa.effect"],
+}
+
+
+def screenlist_query(fields: List[str]):
+    """
+    the SQL for one page of the screening queue with the columns that
+    `fields` need; params are revid, user_id, after and limit (null for all)
+    """
+    unknown = [f for f in fields if f not in SCREENLIST_COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    # pmid is always returned, it is the cursor
+    columns = ["pm.pmid"]
+    for f in fields:
+        columns += [c for c in SCREENLIST_COLUMNS[f] if c not in columns]
+
+    return text(f"""select {', '.join(columns)} from manscreen as ms, pubmed as pm,
+            pubmed_annotations as pa, permissions where permissions.revid=:revid and permissions.login=:user_id
+            and ms.revid=permissions.revid and decision is null and pm.pmid=ms.pmid and pm.pmid=pa.pmid
+            and (cast(:after as text) is null or ms.pmid > cast(:after as text))
+            order by ms.pmid limit :limit;""")
+
+
+def screenlist_page(rows: list, fields: List[str], limit: Optional[int]) -> tuple:
+    # rows were fetched with limit + 1, the extra one says there is a next page
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['pmid']
+
+    keep = list(dict.fromkeys(["pmid"] + fields))
+    articles = []
+    for r in rows:
+        if "citation" in fields:
+            r['citation'] = get_cite(r['authors'], r['journal'], r['year'])
+        articles.append({f: r[f] for f in keep})
+    return articles, next_cursor
+
+
+@timed_query
+def get_screenlist_from_db(engine, revid: str, user_id: str, after: str = None,
+                           limit: int = None, fields: List[str] = None) -> tuple:
+    """
+    one page of the articles waiting to be screened, after the pmid cursor
+    `after`, with only the requested fields (all of them by default); all
+    of them when limit is None
+
+    returns (articles, next_cursor), next_cursor is None on the last page
+    """
+    fields = list(SCREENLIST_COLUMNS) if fields is None else fields
+    toscreen = pd.read_sql(screenlist_query(fields),
+            engine, params={"revid": revid, "user_id": user_id, "after": after,
+                            "limit": None if limit is None else limit + 1})
+    return screenlist_page(toscreen.to_dict('records'), fields, limit)
+
+# rows per server side cursor fetch when exporting included studies
+EXPORT_CHUNKSIZE = 2000
+
+INCLUDED_STUDIES_SQL = """select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
             pm.pm_data->'journal' as journal from manscreen as ms, pubmed as pm
-            where decision=true and ms.revid=%(revid)s login!='init' and pm.pmid=ms.pmid;""",
-            db.connection(), params={"revid": revid})
-    return included_studies_df
+            where decision=true and ms.revid=%(revid)s and login!='init' and pm.pmid=ms.pmid
+            order by pm.pmid;"""
 
 
+def iter_review_included_studies(engine, revid: str, chunksize: int = EXPORT_CHUNKSIZE):
+    """
+    the included studies of a review as DataFrames of chunksize rows, read
+    from a server side cursor (authors JSON encoded)
+    """
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(INCLUDED_STUDIES_SQL, conn, params={"revid": revid}, chunksize=chunksize):
+            chunk['authors'] = [json.dumps(a) for a in chunk.authors]
+            yield chunk
+
+
+def stream_included_studies_csv(engine, revid: str, gzip: bool = False):
+    # CSV bytes chunk by chunk, optionally as one gzip stream
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+    header = True
+    for chunk in iter_review_included_studies(engine, revid):
+        data = chunk.to_csv(index=False, header=header).encode('utf-8')
+        header = False
+        yield compressor.compress(data) if compressor else data
+    if header:
+        # no rows, still send the column names
+        data = ','.join(["pmid", "year", "ti", "ab", "authors", "journal"]).encode('utf-8') + b'\n'
+        yield compressor.compress(data) if compressor else data
+    if compressor:
+        yield compressor.flush()
+
+
+class _ChunkSink:
+    # write only file object handed to pyarrow, drained after each row group
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def stream_included_studies_parquet(engine, revid: str, compression: str = 'snappy'):
+    # Parquet bytes, one row group per chunk
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("pmid", pa.string()), ("year", pa.int64()), ("ti", pa.string()),
+                        ("ab", pa.string()), ("authors", pa.string()), ("journal", pa.string())])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression=compression)
+    for chunk in iter_review_included_studies(engine, revid):
+        chunk['pmid'] = chunk.pmid.astype(str)
+        writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+@timed_query
 def get_review_status_text(db, revid: str) -> list:
     live_update_studies = pd.read_sql("""select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
             pm.pm_data->'journal' as journal, pa.num_randomized, pa.prob_low_rob, pa.effect, decision from manscreen as ms, pubmed as pm,
@@ -148,28 +323,31 @@ def get_review_status_text(db, revid: str) -> list:
     return template
 
 
+@timed_query
+def get_live_update_studies(db, revid: str) -> pd.DataFrame:
+    return pd.read_sql("""select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
+            pm.pm_data->'journal' as journal, pa.num_randomized, pa.prob_low_rob, pa.effect, decision from manscreen as ms, pubmed as pm,
+            pubmed_annotations as pa where in_live_update=true and ms.revid=%(revid)s and pm.pmid=ms.pmid and pm.pmid=pa.pmid;""",
+            db.connection(), params={"revid": revid})
+
+
 def generate_summary_of_new_evidence(db, revid: str) -> str: 
     
     import requests
     import json
     import time
 
-    live_update_studies = pd.read_sql("""select pm.pmid, pm.year, pm.ti, pm.ab, pm.pm_data->'authors' as authors,
-            pm.pm_data->'journal' as journal, pa.num_randomized, pa.prob_low_rob, pa.effect, decision from manscreen as ms, pubmed as pm,
-            pubmed_annotations as pa where in_live_update=true and pm.pmid=ms.pmid and pm.pmid=pa.pmid;""",
-            db.connection(), params={"revid": revid})
+    live_update_studies = get_live_update_studies(db, revid)
 
     
-    articles = []
-
-    for (idx, citation) in live_update_studies.iterrows():
-        articles.append({"ti": citation.ti, "abs": citation.ab})
+    articles = [{"ti": ti, "abs": ab} for (ti, ab) in zip(live_update_studies.ti, live_update_studies.ab)]
 
    
     headers = {'Content-Type': 'application/json', 'Accept':'application/json'}
     base_url="http://127.0.0.1:5000/"
     #import pdb; pdb.set_trace()
-    summary = requests.post(base_url+'summarize', json=json.dumps({"articles":articles}), headers=headers)
+    with SUMMARIZER_SECONDS.labels('summarize').time():
+        summary = requests.post(base_url+'summarize', json=json.dumps({"articles":articles}), headers=headers)
     return summary.text
 
 
@@ -180,6 +358,7 @@ def get_cite(authors, journal, year) -> str:
     else:
         return f"{journal}. {year}"
 
+@timed_query
 def sumbit_decision_to_db(db: Session, userid, revid, pmid, decision):
     # update the last updated date    
     try:
@@ -192,6 +371,12 @@ def sumbit_decision_to_db(db: Session, userid, revid, pmid, decision):
             db.connection().execute("""UPDATE revmeta SET summary_update_needed = %(decision)s
                                 WHERE revmeta.revid=%(revid)s;""",
                             ({"revid":revid, "decision": decision}))
+        else:
+            # a study taken out of the included ones is in the narrative until it is rebuilt
+            db.connection().execute("""UPDATE revmeta SET summary_update_needed = true
+                                WHERE revmeta.revid=%(revid)s AND EXISTS (SELECT 1 FROM summary_pmids AS sp
+                                    WHERE sp.revid=%(revid)s AND sp.pmid=%(pmid)s);""",
+                            ({"revid":revid, "pmid": pmid}))
         db.commit()
     except:
         db.rollback()
@@ -199,44 +384,53 @@ def sumbit_decision_to_db(db: Session, userid, revid, pmid, decision):
 
 def autocomplete(q):
     """
-    retrieves most likely MeSH PICO terms from data in pico_cui_autocompleter.pck
+    retrieves most likely MeSH PICO terms, precomputed per prefix from
+    pico_cui_autocompleter.pck (see autocomplete_index)
     """
+    return autocomplete_index.autocomplete(q)
 
-    min_char = 3
-    max_return = 5
-    substr = q
-    if substr is None or not pico_trie.has_subtrie(substr):
-        return []
-
-    matches = pico_trie.itervalues(prefix=substr)
-
-    def flat_list(l):
-        return [item for sublist in l for item in sublist]
-
-    def dedupe(l):
-        encountered = set()
-        out = []
-        for r in l:
-            if r['cui_pico_display'] not in encountered:
-                encountered.add(r['cui_pico_display'])
-                out.append(r)
-        return out
-
-    if len(substr) < min_char:
-        # for short ones just return first 5
-        return dedupe(flat_list([r for _, r in zip(range(max_return), matches)]))
-    else:
-        # where we have enough chars, process and get top ranked
-        return sorted(dedupe(flat_list(matches)), key=lambda x: x['count'], reverse=True)[:max_return]
-
+@timed_query
 def get_live_summary_from_db(db, revid: str) -> List[LiveSummarySection]:
     return db.query(LiveSummarySection).filter_by(revid=revid).all()
 
-def submit_live_summary_to_db(db: Session, title: str, date: str, keyword_filter: str, live_summary_sections: LiveSummarySections, csv_path: str, user_login: str):
+def read_init_screen_csv(csv_path: str, review_id: str, chunksize: int = INIT_SCREEN_CHUNKSIZE):
+    """
+    the uploaded screening decisions as validated DataFrames of chunksize
+    rows (pmid, ti, ab, decision plus revid), ready to COPY into init_screen
+    (with not_null=INIT_SCREEN_COLUMNS, empty fields are '' as they were)
+    """
+    first_row = 2  # line number in the file, after the header
+    with closing(get_storage().open(csv_path)) as f:
+        for chunk in pd.read_csv(f, usecols=INIT_SCREEN_COLUMNS, dtype=str,
+                                 keep_default_na=False, chunksize=chunksize):
+            missing_pmid = chunk.pmid.str.strip() == ''
+            if missing_pmid.any():
+                lines = (chunk.index[missing_pmid] - chunk.index[0] + first_row).tolist()
+                raise ValueError(f"rows without a pmid on lines {lines[:10]}")
+            unknown = ~chunk.decision.isin(INIT_SCREEN_DECISIONS)
+            if unknown.any():
+                lines = (chunk.index[unknown] - chunk.index[0] + first_row).tolist()
+                raise ValueError(f"decision is not one of {', '.join(INIT_SCREEN_DECISIONS)} "
+                                 f"on lines {lines[:10]}")
+            first_row += chunk.shape[0]
+            chunk['revid'] = review_id
+            yield chunk[['revid'] + INIT_SCREEN_COLUMNS]
+
+
+@timed_query
+def submit_live_summary_to_db(db: Session, title: str, date: str, keyword_filter: str, live_summary_sections: LiveSummarySections, csv_path: str, user_login: str, review_id: str = None, job=None) -> str:
+    """
+    creates the review: revmeta, live_abstracts, permissions and the
+    init_screen records from the uploaded CSV, all in one transaction
+
+    meant to run as a background job (see jobs.py) for large CSVs, progress
+    is reported in job.progress
+    """
     try:
 
         # Insert to DB table revmeta
-        review_id = generate_rev_id(title)
+        if review_id is None:
+            review_id = generate_rev_id(title)
         # Add time of default of all zeros
         last_updated_date = date + " 00:00:00"
 
@@ -259,23 +453,18 @@ def submit_live_summary_to_db(db: Session, title: str, date: str, keyword_filter
         ]
         db.bulk_save_objects(sections)
 
-        # Insert to DB table init_screen
-        screen_records = []
-        # Read from saved csv and save to DB table init_screen
-        with open(csv_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # should populate into list of models/schemas so we can save to db
-                # add to list of MODEL
-                record = InitScreenRecord(
-                    revid=review_id,
-                    pmid=row['pmid'],
-                    ti=row['ti'],
-                    ab=row['ab'],
-                    decision=row['decision']
-                )
-                screen_records.append(record)
-        db.bulk_save_objects(screen_records)
+        # Insert to DB table init_screen, COPYing the csv a chunk at a time
+        # on the session's own connection so it shares the transaction
+        rows = 0
+        cur = db.connection().connection.cursor()
+        try:
+            for chunk in read_init_screen_csv(csv_path, review_id):
+                copy_into(cur, chunk, 'init_screen', not_null=INIT_SCREEN_COLUMNS)
+                rows += chunk.shape[0]
+                if job is not None:
+                    job.progress = {"rows": rows}
+        finally:
+            cur.close()
 
         # Insert into DB table permissions
         permission = Permission(login=user_login, revid=review_id)
@@ -284,35 +473,16 @@ def submit_live_summary_to_db(db: Session, title: str, date: str, keyword_filter
         db.commit()
         db.refresh(revmeta)
         db.refresh(permission)
+        permission_cache.invalidate(user_login)
+        return review_id
     except:
         db.rollback()
         raise
 
-def get_updated_summary(engine, revid) -> str:
-    """Get the updated summary from one edit at a time model - only one edit per call"""
-    import requests
-    try:
-        # get original summary title
-        original_summary_title = engine.execute("SELECT title FROM revmeta WHERE revid = (%s);", (revid,)).fetchone()[0]
-
-        # get original summary
-        original_summary = engine.execute("SELECT text FROM live_abstracts WHERE revid=(%s) and section='conclusion';", (revid,)).fetchone()[0]
-        
-        # get articles
-        articles = engine.execute(f"SELECT pm.ti, pm.ab FROM pubmed AS pm, manscreen AS ms WHERE ms.revid='{revid}' AND ms.decision=true AND pm.pmid=ms.pmid;").fetchall()
-        
-        # format for API input
-        input_data = get_api_input_format(original_summary_title, original_summary, articles) 
-
-        # call the API   
-        headers = {'Content-Type': 'application/json', 'Accept':'application/json'}
-        update_summarization_url="http://127.0.0.1:8081/update_summary_from_diff"
-        response = requests.post(update_summarization_url, json=input_data, headers=headers)
-        response_json = response.json()
-        print(response_json)
-
-        # update automated narrative
-        engine.execute(f"UPDATE live_abstracts SET text = '{response_json['updated_summary']}' WHERE revid = '{revid}' AND section='automated_narrative_summary'")
-        return response_json['updated_summary']
-    except:
-        raise
\ No newline at end of file
+def get_updated_summary(engine, revid, full_rebuild: bool = False) -> str:
+    """
+    refreshes the automated narrative of the review with the included studies
+    not yet folded into it (see automated_narrative_summary_update.refresh_summary)
+    """
+    from app.automated_narrative_summary_update import refresh_summary
+    return refresh_summary(revid, full_rebuild=full_rebuild, only_if_needed=False)
\ No newline at end of file
@@ -0,0 +1,115 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from app.database import SessionLocal
+
+# background work started by API requests (review ingestion, summaries);
+# jobs live in this worker process, so the status endpoint has to be
+# served by the same process (sticky sessions when running several)
+JOB_WORKERS = 4
+# finished jobs are kept this long for clients to poll
+JOB_KEEP_SECONDS = 24 * 60 * 60
+
+
+class Job:
+
+    def __init__(self, name: str, key=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.key = key
+        self.status = "queued"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        # ids of the users allowed to see the job, everyone who asked for it
+        self.owners = set()
+
+    def to_dict(self) -> dict:
+        return {"job_id": self.id, "name": self.name, "status": self.status,
+                "progress": self.progress, "result": self.result, "error": self.error}
+
+
+class JobRegistry:
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, fn, *args, key=None, owner=None, **kwargs) -> Job:
+        """
+        runs fn(job, *args, **kwargs) in the background; fn can report
+        progress through job.progress, its return value becomes job.result
+
+        while a job submitted with the same key is queued or running, that
+        job is returned instead of starting another one (and owner is
+        added to its owners)
+        """
+        with self._lock:
+            if key is not None and key in self._inflight:
+                job = self._inflight[key]
+                if owner is not None:
+                    job.owners.add(owner)
+                return job
+            self._expire()
+            job = Job(name, key)
+            if owner is not None:
+                job.owners.add(owner)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id: str, owner=None) -> Job:
+        """the job, or None if there is none or owner is not one of its owners"""
+        job = self._jobs.get(job_id)
+        if job is None or owner not in job.owners:
+            return None
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                if job.key is not None and self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+
+    def _expire(self):
+        cutoff = time.time() - JOB_KEEP_SECONDS
+        for job_id in [i for i, j in self._jobs.items() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+
+def with_db(fn, pass_job: bool = False):
+    """
+    wraps a crud function taking a Session as its first argument into a job
+    function with a session of its own (the request's is closed by then);
+    pass_job=True hands the job to fn as job= for progress reporting
+    """
+    def run(job, *args, **kwargs):
+        db = SessionLocal()
+        try:
+            if pass_job:
+                kwargs['job'] = job
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+    return run
+
+
+jobs = JobRegistry()
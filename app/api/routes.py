@@ -1,24 +1,27 @@
-from typing import Dict
+from typing import Dict, Optional
 from urllib.parse import urlencode, parse_qsl
 
 import httpx
-from fastapi import APIRouter, Depends, status, HTTPException, File, UploadFile
-from fastapi.responses import StreamingResponse, JSONResponse
-import io
+from fastapi import APIRouter, Depends, status, HTTPException, File, UploadFile, Query, Header
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.settings import settings
-from app.database import get_db, SQLBase, engine
-from .schemas import Url, AuthorizationResponse, GithubUser, User, Token, ReviewList, ArticleList, ScreeningDecision, LiveSummaryData, LiveSummarySections, UpdatedSummary
-from .helpers import generate_token, create_access_token, generate_uuid
-from .crud import get_user_by_login, create_user, get_user, get_reviewlist_from_db, get_screenlist_from_db, sumbit_decision_to_db, get_review_status_text, get_review_included_studies_df, generate_summary_of_new_evidence, autocomplete, submit_live_summary_to_db, get_live_summary_from_db, update_user, get_updated_summary
+from app import metrics
+from app.profiling import profiler_config, profile_path
+from app.database import get_db, get_async_db, engine
+from .schemas import Url, AuthorizationResponse, GithubUser, User, Token, ReviewList, ArticleList, ScreeningDecision, LiveSummaryData, LiveSummarySections, UpdatedSummary, ProfilerSettings, JobStatus
+from .helpers import generate_token, create_access_token, generate_uuid, generate_rev_id
+from .crud import SCREENLIST_MAX_PAGE_SIZE, get_user_by_login, create_user, get_user, get_cached_user, get_user_revids, get_reviewlist_from_db, get_screenlist_from_db, sumbit_decision_to_db, stream_included_studies_csv, stream_included_studies_parquet, generate_summary_of_new_evidence, autocomplete, submit_live_summary_to_db, get_live_summary_from_db, update_user, get_updated_summary
+from . import async_crud
+from .jobs import jobs, with_db
+from .storage import save_upload, UploadTooLarge
 from .dependencies import get_user_from_header
 from .models import User as DbUser
 from fastapi.encoders import jsonable_encoder
 
 import app
-import shutil
-import os
 import json
 
 LOGIN_URL = "https://github.com/login/oauth/authorize"
@@ -26,9 +29,6 @@ REDIRECT_URL = f"{settings.app_url}/auth/github"
 TOKEN_URL = "https://github.com/login/oauth/access_token"
 USER_URL = "https://api.github.com/user"
 
-# create tables if not exist
-SQLBase.metadata.create_all(engine)    
-
 router = APIRouter()
 
 @router.get("/login")
@@ -77,12 +77,54 @@ async def verify_authorization(
     return Token(access_token=access_token, token_type="bearer", user=db_user)
 
 
+@router.get("/metrics")
+def get_metrics(authorization: str = Header(None)):
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not metrics.is_authorised(token):
+        raise HTTPException(status_code=403, detail="Not authorised to read metrics")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@router.post("/profiler")
+def set_profiler(profiler_settings: ProfilerSettings, x_profile_token: str = Header(None)):
+    """
+    profiles sample_rate of the requests under the given route prefixes
+    (in this worker process), sample_rate=0 switches sampling off
+    """
+    if not profiler_config.is_authorised(x_profile_token):
+        raise HTTPException(status_code=403, detail="Not authorised to profile")
+    profiler_config.routes = profiler_settings.routes
+    profiler_config.sample_rate = profiler_settings.sample_rate
+    return {"routes": profiler_config.routes, "sample_rate": profiler_config.sample_rate}
+
+
+@router.get("/profiles/{name}")
+def get_profile(name: str, x_profile_token: str = Header(None)):
+    if not profiler_config.is_authorised(x_profile_token):
+        raise HTTPException(status_code=403, detail="Not authorised to profile")
+    try:
+        path = profile_path(name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    # read here rather than with FileResponse, which needs aiofiles; this
+    # (sync) route runs in the threadpool. Old profiles are pruned while
+    # the server runs, so the file may be gone
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(content, media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+
 @router.get("/get_session", response_model=User)
-def get_session(
+async def get_session(
     user: User = Depends(get_user_from_header),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> DbUser:
-    db_user = get_user(db, user.id)
+    db_user = await async_crud.get_cached_user(db, user.id)
 
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -90,27 +132,44 @@ def get_session(
 
 
 @router.get("/get_reviewlist", response_model=ReviewList)
-def get_reviewlist(user: User = Depends(get_user_from_header),
-                   db: Session = Depends(get_db),
+async def get_reviewlist(user: User = Depends(get_user_from_header),
+                   db: AsyncSession = Depends(get_async_db),
 ) -> ReviewList:
-    db_user = get_user(db, user.id)
+    db_user = await async_crud.get_cached_user(db, user.id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return {"reviews": get_reviewlist_from_db(engine, user.login)}
+    return {"reviews": await async_crud.get_reviewlist_from_db(db, user.login)}
 
 
 @router.get("/get_screenlist/{revid}", response_model=ArticleList)
-def get_screenlist(revid: str,
+async def get_screenlist(revid: str,
+                   after: Optional[str] = None,
+                   limit: Optional[int] = Query(None, ge=1, le=SCREENLIST_MAX_PAGE_SIZE),
+                   fields: Optional[str] = None,
                    user: User = Depends(get_user_from_header),
-                   db: Session = Depends(get_db),
+                   db: AsyncSession = Depends(get_async_db),
 
 ) -> ArticleList:
-    db_user = get_user(db, user.id)
+    """
+    the articles to screen, all of them unless a limit is given; with a limit,
+    pass the next_cursor of one page as `after` to get the next. fields= is a
+    comma separated list (e.g. pmid,ti,citation), the articles then have only
+    those keys (and pmid)
+    """
+    db_user = await async_crud.get_cached_user(db, user.id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    articles = get_screenlist_from_db(engine, revid, user.login)
-    return {"articles": articles}
+    try:
+        articles, next_cursor = await async_crud.get_screenlist_from_db(
+            db, revid, user.login, after=after, limit=limit,
+            fields=fields.split(",") if fields else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if fields:
+        # returned as is, through ArticleList the other fields would be null
+        return JSONResponse(jsonable_encoder({"articles": articles, "next_cursor": next_cursor}))
+    return {"articles": articles, "next_cursor": next_cursor}
 
 
 @router.post("/update_abstract/")
@@ -118,41 +177,50 @@ def update_abstract(
                decision: ScreeningDecision,
                user: User = Depends(get_user_from_header),
                db: Session = Depends(get_db),):
-    db_user = get_user(db, user.id)
+    db_user = get_cached_user(db, user.id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")    
+    if (decision.revid not in get_user_revids(db, user.login)
+            and decision.revid not in get_user_revids(db, user.login, refresh=True)):
+        raise HTTPException(status_code=403, detail="No permission for this review")
     sumbit_decision_to_db(db, user.login, decision.revid, decision.pmid, decision.decision)
     return {"didit": True}
 
 
-@router.get("/summarize_new_evidence/{revid}")
+@router.get("/summarize_new_evidence/{revid}", response_model=JobStatus)
 def get_generated_summary(
-               revid: str,               
-               db: Session = Depends(get_db),):    
-    #update_text = get_review_status_text(db, revid)
-    #return update_text
-    #import pdb; pdb.set_trace()
-    summary = generate_summary_of_new_evidence(db, revid)
-    return summary
+               revid: str,
+               user: User = Depends(get_user_from_header),) -> JobStatus:
+    # runs as a background job, the summary is the job's result
+    # (clicking again while it runs returns the same job)
+    job = jobs.submit("summarize_new_evidence", with_db(generate_summary_of_new_evidence), revid,
+                      key=("summarize_new_evidence", revid), owner=user.id)
+    return job.to_dict()
 
 
 
 @router.get("/get_review_included_studies/{revid}")
 def get_review_included_studies(
-               revid: str,               
-               db: Session = Depends(get_db),):    
-    update_text = get_review_status_text(db, revid)
-    stream = io.StringIO()
-
-    df = get_review_included_studies_df(db, revid)
-
-    df.to_csv(stream, index = False)
-
-    response = StreamingResponse(iter([stream.getvalue()]),
-                        media_type="text/csv"
-    )
-
-    response.headers["Content-Disposition"] = "attachment; filename=included_studies.csv"
+               revid: str,
+               format: str = Query("csv", regex="^(csv|parquet)$"),
+               compression: Optional[str] = Query(None, regex="^gzip$"),):
+    """
+    streams the included studies as CSV (optionally gzipped) or Parquet
+    (compression=gzip picks the Parquet codec, snappy otherwise)
+    """
+    if format == "parquet":
+        stream = stream_included_studies_parquet(engine, revid, compression=compression or "snappy")
+        media_type, filename = "application/octet-stream", "included_studies.parquet"
+    elif compression == "gzip":
+        stream = stream_included_studies_csv(engine, revid, gzip=True)
+        media_type, filename = "application/gzip", "included_studies.csv.gz"
+    else:
+        stream = stream_included_studies_csv(engine, revid)
+        media_type, filename = "text/csv", "included_studies.csv"
+
+    response = StreamingResponse(stream, media_type=media_type)
+
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
 
     return response
 
@@ -167,7 +235,7 @@ def create_live_summary(
                 live_summary: LiveSummaryData,
                 user: User = Depends(get_user_from_header),
                 db: Session = Depends(get_db),):
-    db_user = get_user(db, user.id)
+    db_user = get_cached_user(db, user.id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -182,13 +250,28 @@ def create_live_summary(
         conclusion=live_summary.conclusion
     )
 
-    submit_live_summary_to_db(db, live_summary.name, live_summary.date, keyword_filter, live_summary_sections, live_summary.document[0].path, user.login)
-    return {"success": True}
+    # the init_screen CSV can be tens of thousands of rows, so the review is
+    # created in a background job; poll /api/jobs/{job_id} for progress
+    review_id = generate_rev_id(live_summary.name)
+    job = jobs.submit("create_live_summary", with_db(submit_live_summary_to_db, pass_job=True),
+                      live_summary.name, live_summary.date, keyword_filter, live_summary_sections,
+                      live_summary.document[0].path, user.login, review_id=review_id, owner=user.id)
+    return {"success": True, "revid": review_id, "job_id": job.id}
+
+
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+def get_job(job_id: str,
+            user: User = Depends(get_user_from_header),) -> JobStatus:
+    # only the users who started (or joined) the job can see it
+    job = jobs.get(job_id, owner=user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 @router.get("/get_live_review_summary/{revid}", response_model=LiveSummarySections)
-def get_reviewlist(revid: str,               
-                db: Session = Depends(get_db),) -> LiveSummarySections:
-    live_summary_sections_from_db = get_live_summary_from_db(db, revid)
+async def get_live_review_summary(revid: str,               
+                db: AsyncSession = Depends(get_async_db),) -> LiveSummarySections:
+    live_summary_sections_from_db = await async_crud.get_live_summary_from_db(db, revid)
 
     if len(live_summary_sections_from_db) == 0:
         return LiveSummarySections()
@@ -218,21 +301,26 @@ def update_user_information(
 
 @router.post("/upload_csv")
 async def upload_csv(csv_file: UploadFile = File(...)):
-    uuid = generate_uuid(5)
-    filename = uuid + "-" + csv_file.filename
-    file_location = os.path.join(app.CSV_ROOT, filename)
-    with open(file_location, "wb+") as file_object:
-        shutil.copyfileobj(csv_file.file, file_object)
+    # stored under the hash of its content (see storage.py), the path is
+    # what create_live_summary gets back as document.path
+    try:
+        file_location = await save_upload(csv_file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     
-    return {"name": filename, "path": file_location}
+    return {"name": csv_file.filename, "path": file_location}
 
-@router.get("/get_updated_summary/{revid}", response_model=UpdatedSummary)
-def get_screenlist(revid: str,
+@router.get("/get_updated_summary/{revid}", response_model=JobStatus)
+def get_updated_summary_job(revid: str,
+                   full_rebuild: bool = False,
                    user: User = Depends(get_user_from_header),
                    db: Session = Depends(get_db),
-) -> UpdatedSummary:
-    db_user = get_user(db, user.id)
+) -> JobStatus:
+    db_user = get_cached_user(db, user.id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    updated_summary = get_updated_summary(engine, revid)
-    return {"updated_summary": updated_summary}
+    # runs as a background job, the updated summary is the job's result;
+    # only the included studies not yet in the narrative are sent unless full_rebuild
+    job = jobs.submit("get_updated_summary", lambda job, revid: get_updated_summary(engine, revid, full_rebuild), revid,
+                      key=("get_updated_summary", revid, full_rebuild), owner=user.id)
+    return job.to_dict()
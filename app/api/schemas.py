@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 import datetime
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 
 
 class Url(BaseModel):
@@ -50,18 +50,19 @@ class Article(BaseModel):
     structured Trialstreamer data on an article
     """
     pmid: str
-    year: int
-    ti: str
-    ab: str
-    citation: str
-    journal: str
+    year: int = None
+    ti: str = None
+    ab: str = None
+    citation: str = None
+    journal: str = None
     num_randomized: str = None
-    prob_low_rob: float
-    effect: str
+    prob_low_rob: float = None
+    effect: str = None
     decision: str = None
 
 class ArticleList(BaseModel):
     articles: List[Article] = None
+    next_cursor: Optional[str] = None
 
 class ScreeningDecision(BaseModel):
     pmid: str
@@ -96,3 +97,15 @@ class LiveSummarySections(BaseModel):
 
 class UpdatedSummary(BaseModel):
     updated_summary: str
+
+class ProfilerSettings(BaseModel):
+    routes: List[str] = []
+    sample_rate: float = 0.0
+
+class JobStatus(BaseModel):
+    job_id: str
+    name: str
+    status: str
+    progress: Dict[str, Any] = None
+    result: Any = None
+    error: Optional[str] = None
@@ -0,0 +1,229 @@
+import abc
+import hashlib
+import importlib.util
+import os
+import tempfile
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+import app
+
+# uploads are read and written this much at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+# room for the multipart boundaries and part headers around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class StorageBackend(abc.ABC):
+    """
+    where uploaded CSVs live, keyed by the sha256 of their content so the
+    same file uploaded twice is stored once
+    """
+
+    def tmp_dir(self) -> str:
+        # where uploads are spooled before put(), None for the system default
+        return None
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, tmp_path: str):
+        # moves/uploads the finished temporary file tmp_path to key
+        pass
+
+    @abc.abstractmethod
+    def location(self, key: str) -> str:
+        # what is handed back to the client and later passed to open()
+        pass
+
+    @abc.abstractmethod
+    def open(self, location: str):
+        # binary file object for a location made by this backend
+        pass
+
+
+class LocalStorage(StorageBackend):
+
+    def __init__(self, root: str = app.CSV_ROOT):
+        self.root = root
+        os.makedirs(self.tmp_dir(), exist_ok=True)
+
+    def tmp_dir(self) -> str:
+        # on the same filesystem as root, so put() is an atomic rename
+        return os.path.join(self.root, ".tmp")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.location(key))
+
+    def put(self, key: str, tmp_path: str):
+        os.replace(tmp_path, self.location(key))
+
+    def location(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def open(self, location: str):
+        path = os.path.realpath(location)
+        if os.path.commonpath([path, os.path.realpath(self.root)]) != os.path.realpath(self.root):
+            raise ValueError(f"{location} is not an uploaded file")
+        return open(path, 'rb')
+
+
+class S3Storage(StorageBackend):
+
+    def __init__(self, bucket: str, prefix: str = "", client=None):
+        if client is None and importlib.util.find_spec("boto3") is None:
+            raise RuntimeError(f"RRLIVE_UPLOAD_STORAGE=s3://{bucket} needs boto3, pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client("s3")
+        return self._client
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError:
+            return False
+
+    def put(self, key: str, tmp_path: str):
+        self.client.upload_file(tmp_path, self.bucket, self._key(key))
+        os.remove(tmp_path)
+
+    def location(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self._key(key)}"
+
+    def open(self, location: str):
+        prefix = f"s3://{self.bucket}/"
+        if not location.startswith(prefix):
+            raise ValueError(f"{location} is not an uploaded file")
+        return self.client.get_object(Bucket=self.bucket, Key=location[len(prefix):])["Body"]
+
+
+_storage = None
+
+
+def get_storage() -> StorageBackend:
+    """
+    RRLIVE_UPLOAD_STORAGE=s3://bucket/prefix to store uploads in S3 (needs
+    boto3, which is not in requirements.txt), app.CSV_ROOT on local disk
+    otherwise
+    """
+    global _storage
+    if _storage is None:
+        target = os.environ.get("RRLIVE_UPLOAD_STORAGE", "")
+        if target.startswith("s3://"):
+            bucket, _, prefix = target[len("s3://"):].partition("/")
+            _storage = S3Storage(bucket, prefix)
+        else:
+            _storage = LocalStorage(target or app.CSV_ROOT)
+    return _storage
+
+
+async def save_upload(upload, storage: StorageBackend = None, max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    """
+    reads the upload a chunk at a time, hashing it as it goes, with the disk
+    writes off the event loop; returns the location of the stored file
+    """
+    storage = get_storage() if storage is None else storage
+    sha = hashlib.sha256()
+    size = 0
+    tmp = await run_in_threadpool(tempfile.NamedTemporaryFile, suffix=".upload", dir=storage.tmp_dir(), delete=False)
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"uploads are limited to {max_bytes} bytes")
+            sha.update(chunk)
+            await run_in_threadpool(tmp.write, chunk)
+        await run_in_threadpool(tmp.close)
+
+        ext = os.path.splitext(upload.filename or "")[1].lower() or ".csv"
+        key = sha.hexdigest() + ext
+        if await run_in_threadpool(storage.exists, key):
+            await run_in_threadpool(os.remove, tmp.name)
+        else:
+            await run_in_threadpool(storage.put, key, tmp.name)
+        return storage.location(key)
+    except:
+        tmp.close()
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+
+
+class UploadLimitMiddleware:
+    """
+    rejects uploads to paths with a 413 before their body is read: up front
+    when the Content-Length is over max_bytes, otherwise as soon as that
+    many bytes have arrived (the form parser would spool all of it first)
+    """
+
+    def __init__(self, app, paths=("/api/upload_csv",), max_bytes: int = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD):
+        self.app = app
+        self.paths = tuple(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse({"detail": f"uploads are limited to {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+        for k, v in scope["headers"]:
+            if k == b"content-length" and v.isdigit() and int(v) > self.max_bytes:
+                await too_large(scope, receive, send)
+                return
+
+        received = 0
+        started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes and not started:
+                    # answer now; the app sees a disconnected client and
+                    # whatever it sends afterwards is dropped
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def track_send(message):
+            nonlocal started
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, track_send)
+        except Exception:
+            if not rejected:
+                raise
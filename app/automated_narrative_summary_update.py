@@ -2,82 +2,218 @@
 # Update Summarization for each review
 #
 
+import asyncio
 import pandas as pd
 import requests
+import httpx
 import json
 import os
+import sys
+import time
+import traceback
 import urllib.parse
 
 from typing import Generator
-from .database import engine
+from .database import engine, ensure_schema
+from .metrics import SUMMARIZER_SECONDS
+from .summary_cache import cached_summary, cached_summary_async
 
 update_summarization_url="http://127.0.0.1:8081/update_summary"
 update_summarization_from_diff_url="http://127.0.0.1:8081/update_summary_from_diff"
 update_diff_url="http://127.0.0.1:8081/update_diff"
 
-def get_api_input_format(original_summary, articles_list):
-    # Currently don't have original summary title so will just pass empty string
+# reviews refreshed at once by main(), each summarizer call is given up
+# after SUMMARY_TIMEOUT seconds and retried SUMMARY_RETRIES times, waiting
+# SUMMARY_BACKOFF seconds before the first retry and doubling after that
+SUMMARY_CONCURRENCY = int(os.environ.get('RRLIVE_SUMMARY_CONCURRENCY', 4))
+SUMMARY_TIMEOUT = float(os.environ.get('RRLIVE_SUMMARY_TIMEOUT', 600))
+SUMMARY_CONNECT_TIMEOUT = 10
+SUMMARY_RETRIES = 2
+SUMMARY_BACKOFF = 5
+
+HEADERS = {'Content-Type': 'application/json', 'Accept':'application/json'}
+
+def get_api_input_format(original_summary, articles_list, title=""):
     return {
-        "existing_summary_title": "",
+        "existing_summary_title": title,
         "existing_summary": original_summary,
         "articles": articles_list
     }
 
-def fetch_updated_summary(input_data):
-    headers = {'Content-Type': 'application/json', 'Accept':'application/json'}
-    response = requests.post(update_summarization_url, json=input_data, headers=headers)
+def fetch_updated_summary(input_data, url=update_summarization_url):
+    with SUMMARIZER_SECONDS.labels(url.rsplit('/', 1)[-1]).time():
+        response = requests.post(url, json=input_data, headers=HEADERS, timeout=(SUMMARY_CONNECT_TIMEOUT, SUMMARY_TIMEOUT))
+    response.raise_for_status()
     return response.json()
 
+async def fetch_updated_summary_async(client, input_data, url=update_summarization_url, retries=SUMMARY_RETRIES, backoff=SUMMARY_BACKOFF):
+    # retries timeouts, connection errors and 5xx responses
+    for attempt in range(retries + 1):
+        try:
+            with SUMMARIZER_SECONDS.labels(url.rsplit('/', 1)[-1]).time():
+                response = await client.post(url, json=input_data, headers=HEADERS)
+            response.raise_for_status()
+            return response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500
+            if not retryable or attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"summarizer call failed ({e!r}), retrying in {wait}s")
+            await asyncio.sleep(wait)
+
 ####### UPDATES #########
 
-def update_automated_narrative(text, revid):
-    engine.execute(f"UPDATE live_abstracts SET text = '{text}' WHERE revid = '{revid}' AND section='automated_narrative_summary'")
+def save_summary(revid, text, pmids, full_rebuild):
+    """
+    stores the new narrative together with the pmids folded into it (all of
+    them after a full rebuild, the new ones otherwise) and clears
+    summary_update_needed, in one transaction
+    """
+    with engine.begin() as conn:
+        conn.execute("UPDATE live_abstracts SET text = %s WHERE revid = %s AND section='automated_narrative_summary'", (text, revid))
+        if full_rebuild:
+            conn.execute("DELETE FROM summary_pmids WHERE revid = %s", (revid,))
+        if pmids:
+            conn.execute("INSERT INTO summary_pmids (revid, pmid) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                         [(revid, pmid) for pmid in pmids])
+        conn.execute("UPDATE revmeta SET summary_update_needed = false WHERE revid = %s", (revid,))
+
+def prepare_refresh(revid, full_rebuild=False, only_if_needed=True):
+    """
+    what refreshing the narrative of revid takes: the included studies which
+    are not yet reflected in it are folded in (update_summary_from_diff with
+    the current narrative and only the new articles); full_rebuild, a review
+    without a record of folded pmids, or one with a folded study which is no
+    longer included (the diff cannot take it out), rebuilds it from the
+    conclusion and all included studies. None when no refresh is needed, a
+    plan with input_data None when there are no new studies
+    """
+    meta = engine.execute("SELECT title, coalesce(summary_update_needed, FALSE) AS needed FROM revmeta WHERE revid=(%s);", (revid,)).fetchone()
+    # skip reviews which have been refreshed since they were queued
+    if meta is None or (only_if_needed and not meta.needed):
+        print(f"No summary update needed {revid} ")
+        return None
+
+    print(f"Starting update summarization of the {revid} review")
+    narrative = engine.execute("SELECT text FROM live_abstracts WHERE revid=(%s) and section='automated_narrative_summary';", (revid,)).fetchone()
+    narrative = narrative[0] if narrative is not None else None
+    has_record = engine.execute("SELECT 1 FROM summary_pmids WHERE revid=(%s) LIMIT 1;", (revid,)).fetchone() is not None
+    removed = engine.execute("""SELECT 1 FROM summary_pmids AS sp WHERE sp.revid=(%s)
+        AND NOT EXISTS (SELECT 1 FROM manscreen AS ms WHERE ms.revid=sp.revid AND ms.pmid=sp.pmid AND ms.decision=true)
+        LIMIT 1;""", (revid,)).fetchone() is not None
+    full_rebuild = full_rebuild or not narrative or not has_record or removed
+
+    print(f"Fetching manually labelled studies from screener {revid} ")
+    if full_rebuild:
+        existing_summary = engine.execute("SELECT text FROM live_abstracts WHERE revid=(%s) and section='conclusion';", (revid,)).fetchone()[0]
+        url = update_summarization_url
+        articles = engine.execute("SELECT pm.pmid, pm.ti, pm.ab FROM pubmed AS pm, manscreen AS ms WHERE ms.revid=(%s) AND ms.decision=true AND pm.pmid=ms.pmid;", (revid,)).fetchall()
+    else:
+        existing_summary = narrative
+        url = update_summarization_from_diff_url
+        articles = engine.execute("""SELECT pm.pmid, pm.ti, pm.ab FROM pubmed AS pm, manscreen AS ms
+            WHERE ms.revid=(%s) AND ms.decision=true AND pm.pmid=ms.pmid
+            AND NOT EXISTS (SELECT 1 FROM summary_pmids AS sp WHERE sp.revid=ms.revid AND sp.pmid=ms.pmid);""", (revid,)).fetchall()
+
+    plan = {"revid": revid, "full_rebuild": full_rebuild, "url": url, "narrative": narrative,
+            "pmids": [art.pmid for art in articles], "input_data": None,
+            "title": meta.title or "", "existing_summary": existing_summary}
+    if not articles and not full_rebuild:
+        print(f"No new included studies since the last summary {revid} ")
+        return plan
+    print(f"{'Rebuilding' if full_rebuild else 'Updating'} the summary with {len(articles)} articles {revid} ")
+
+    article_list = [{'title': art.ti, 'abstract': art.ab} for art in articles]
+    plan["input_data"] = get_api_input_format(existing_summary, article_list, meta.title or "")
+    return plan
+
+def finish_refresh(plan, updated_summary):
+    revid = plan["revid"]
+    if plan["input_data"] is None:
+        # nothing new, just clear summary_update_needed
+        save_summary(revid, plan["narrative"], [], False)
+        return plan["narrative"]
 
-def update_summary_update_needed(revid):
-    engine.execute(f"UPDATE revmeta SET summary_update_needed = false WHERE revid = '{revid}'")
+    # for debug
+    print(f"Print updated summary output {revid} ")   
+    print(updated_summary)
     
-def main():
+    print(f"Saving all the relevant data back in the database {revid} ")        
+    save_summary(revid, updated_summary, plan["pmids"], plan["full_rebuild"])
+    print(f"FINISHED - ALL COMPLETE :) {revid} ")
+    return updated_summary
+
+def refresh_summary(revid, full_rebuild=False, only_if_needed=True):
+    """
+    refreshes the automated narrative of one review (see prepare_refresh),
+    returns the narrative, None when skipped as not needed
+    """
+    plan = prepare_refresh(revid, full_rebuild, only_if_needed)
+    if plan is None:
+        return None
+    updated_summary = None
+    if plan["input_data"] is not None:
+        print(f"Getting updated summarization with API (will take a while) {revid} ")        
+        updated_summary = cached_summary(
+            plan["title"], plan["existing_summary"], plan["pmids"], plan["url"],
+            lambda: fetch_updated_summary(plan["input_data"], plan["url"])["updated_summary"])
+    return finish_refresh(plan, updated_summary)
+
+async def refresh_summary_async(client, revid, full_rebuild=False, only_if_needed=True):
+    # same as refresh_summary, with the database work on the default executor
+    loop = asyncio.get_running_loop()
+    plan = await loop.run_in_executor(None, prepare_refresh, revid, full_rebuild, only_if_needed)
+    if plan is None:
+        return None
+    updated_summary = None
+    if plan["input_data"] is not None:
+        async def fetch():
+            print(f"Getting updated summarization with API (will take a while) {revid} ")
+            response = await fetch_updated_summary_async(client, plan["input_data"], plan["url"])
+            return response["updated_summary"]
+        updated_summary = await cached_summary_async(
+            plan["title"], plan["existing_summary"], plan["pmids"], plan["url"], fetch)
+    return await loop.run_in_executor(None, finish_refresh, plan, updated_summary)
+
+async def refresh_all(revids, full_rebuild=False, concurrency=SUMMARY_CONCURRENCY, timeout=SUMMARY_TIMEOUT) -> dict:
+    """
+    refreshes up to `concurrency` reviews at a time, a failing review does
+    not stop the others; returns {revid: {"status", "seconds", "error"}}
+    with status one of updated, skipped, failed
+    """
+    sem = asyncio.Semaphore(concurrency)
+    report = {}
+
+    async def one(client, revid):
+        async with sem:
+            started = time.perf_counter()
+            try:
+                summary = await refresh_summary_async(client, revid, full_rebuild)
+                report[revid] = {"status": "skipped" if summary is None else "updated", "error": None}
+            except Exception as e:
+                traceback.print_exc()
+                report[revid] = {"status": "failed", "error": repr(e)}
+            report[revid]["seconds"] = round(time.perf_counter() - started, 1)
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout, connect=SUMMARY_CONNECT_TIMEOUT)) as client:
+        await asyncio.gather(*(one(client, revid) for revid in revids))
+    return report
+
+def main(full_rebuild=False, concurrency=SUMMARY_CONCURRENCY):
+    ensure_schema()
     # MAIN LOOP
     revids_to_update_ = engine.execute("select revid, title, last_updated, summary_update_needed from revmeta where coalesce(summary_update_needed, FALSE) = TRUE;").fetchall()
     revids_to_update = [i.revid for i in revids_to_update_]
 
-    for revid in revids_to_update:
-        
-        print(f"Starting update summarization of the {revid} review")
-        original_summary = engine.execute("SELECT text FROM live_abstracts WHERE revid=(%s) and section='conclusion';", (revid,)).fetchone()[0]
-        
-        print(f"Fetching manually labelled studies from screener {revid} ")
-        articles = engine.execute(f"SELECT pm.ti, pm.ab FROM pubmed AS pm, manscreen AS ms WHERE ms.revid='{revid}' AND ms.decision=true AND pm.pmid=ms.pmid;").fetchall()
-        print(revid)
-
-        article_list = []
-
-        print(f"Preparing data for Update Summarization API format {revid} ")
-
-        for art in articles:
-            row = {
-                    'title': art.ti,
-                    'abstract': art.ab,
-                  }
-            article_list.append(row)
-        
-        # call the update summarization API
-        print(f"Preparing data for Update Summarization API {revid} ")
-        input_data = get_api_input_format(original_summary, article_list)
-        print(f"Getting updated summarization with API (will take a while) {revid} ")        
-        response = fetch_updated_summary(input_data)
-        
-        # for debug
-        print(f"Print updated summary output {revid} ")   
-        print(response)
-        
-        print(f"Saving all the relevant data back in the database {revid} ")        
-        
-        print("Updating automated_narrative_summary...") 
-        update_automated_narrative(response["updated_summary"], revid)
-        print("Updating revmeta summary_update_needed...")  
-        update_summary_update_needed(revid)
-        print(f"FINISHED - ALL COMPLETE :) {revid} ")
+    started = time.perf_counter()
+    report = asyncio.run(refresh_all(revids_to_update, full_rebuild, concurrency))
+    for revid, result in report.items():
+        print(f"{revid}: {result['status']} in {result['seconds']}s" + (f" ({result['error']})" if result['error'] else ""))
+    failed = [revid for revid, result in report.items() if result['status'] == 'failed']
+    print(f"refreshed {len(report) - len(failed)}/{len(report)} reviews in {time.perf_counter() - started:.1f}s")
+    return report
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    report = main(full_rebuild='--full-rebuild' in sys.argv)
+    sys.exit(1 if any(result['status'] == 'failed' for result in report.values()) else 0)
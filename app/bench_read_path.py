@@ -0,0 +1,108 @@
+#
+#   compares the sync (threadpool) and async data access paths of the hot
+#   read endpoints under concurrent load
+#
+#   python -m app.bench_read_path <login> <user id> <revid> [concurrency] [requests]
+#
+
+import asyncio
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import engine, SessionLocal, async_session, get_async_engine
+from .api import crud, async_crud
+
+# starlette runs sync endpoints on the event loop's default executor
+SYNC_THREADS = 40
+
+
+def sync_calls(login, user_id, revid):
+    def get_session():
+        with SessionLocal() as db:
+            crud.get_user(db, user_id)
+
+    def get_reviewlist():
+        crud.get_reviewlist_from_db(engine, login)
+
+    def get_screenlist():
+        crud.get_screenlist_from_db(engine, revid, login)
+
+    def get_live_review_summary():
+        with SessionLocal() as db:
+            crud.get_live_summary_from_db(db, revid)
+
+    return [get_session, get_reviewlist, get_screenlist, get_live_review_summary]
+
+
+def async_calls(login, user_id, revid):
+    async def get_session():
+        async with async_session() as db:
+            await async_crud.get_user(db, user_id)
+
+    async def get_reviewlist():
+        async with async_session() as db:
+            await async_crud.get_reviewlist_from_db(db, login)
+
+    async def get_screenlist():
+        async with async_session() as db:
+            await async_crud.get_screenlist_from_db(db, revid, login)
+
+    async def get_live_review_summary():
+        async with async_session() as db:
+            await async_crud.get_live_summary_from_db(db, revid)
+
+    return [get_session, get_reviewlist, get_screenlist, get_live_review_summary]
+
+
+async def run_sync(fn, concurrency, n) -> list:
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=SYNC_THREADS)
+    sem = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one():
+        async with sem:
+            started = time.perf_counter()
+            await loop.run_in_executor(executor, fn)
+            timings.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one() for _ in range(n)))
+    executor.shutdown()
+    return timings
+
+
+async def run_async(fn, concurrency, n) -> list:
+    sem = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one():
+        async with sem:
+            started = time.perf_counter()
+            await fn()
+            timings.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one() for _ in range(n)))
+    return timings
+
+
+def report(name, path, timings, elapsed):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<26}{path:<7}{len(timings) / elapsed:>10.1f} req/s"
+          f"   p50 {statistics.median(timings) * 1000:>8.1f} ms   p95 {p95 * 1000:>8.1f} ms")
+
+
+async def main(login, user_id, revid, concurrency=200, n=2000):
+    for sync_fn, async_fn in zip(sync_calls(login, user_id, revid), async_calls(login, user_id, revid)):
+        for path, runner, fn in (("sync", run_sync, sync_fn), ("async", run_async, async_fn)):
+            started = time.perf_counter()
+            timings = await runner(fn, concurrency, n)
+            report(sync_fn.__name__, path, timings, time.perf_counter() - started)
+    await get_async_engine().dispose()
+
+
+if __name__ == '__main__':
+    login, user_id, revid = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    asyncio.run(main(login, user_id, revid, *(int(a) for a in sys.argv[4:6])))
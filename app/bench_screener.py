@@ -0,0 +1,75 @@
+#
+#   times training and scoring with the screener backends on the labelled
+#   data of one review, scoring the newest pubmed articles
+#
+#   python -m app.bench_screener <revid> [backends] [articles] [repeats]
+#
+#   backends is a comma separated list (default local). A remote screener
+#   has to be named with its url, e.g. local,remote=http://localhost:5000/,
+#   the production one is never picked by default. Models are trained under
+#   bench-<revid> (the local one in a temporary directory), so the review's
+#   own models are left alone
+#
+
+import statistics
+import sys
+import tempfile
+import time
+
+from .database import engine
+from .review_update import get_training_data
+from .screener import LocalScreener, RemoteScreener
+
+
+def newest_articles(n) -> list:
+    rows = engine.execute("SELECT ti, ab FROM pubmed ORDER BY update_date DESC, pmid LIMIT %s;", (n,)).fetchall()
+    return [{'ti': row.ti, 'abs': row.ab} for row in rows]
+
+
+def bench(screener, revid, data, articles, repeats) -> dict:
+    key = f"bench-{revid}"
+    started = time.perf_counter()
+    screener.train(key, [{'ti': row['ti'], 'abs': row['abs'], 'label': row['label']} for row in data])
+    train_seconds = time.perf_counter() - started
+
+    predict_seconds = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        predictions = screener.predict(key, articles)["predictions"]
+        predict_seconds.append(time.perf_counter() - started)
+        assert len(predictions) == len(articles)
+    median = statistics.median(predict_seconds)
+    return {"train": train_seconds, "predict": median, "predict_min": min(predict_seconds),
+            "articles_per_second": len(articles) / median}
+
+
+def parse_backend(backend) -> tuple:
+    # 'local' or 'remote=<url>' -> (name, url)
+    name, _, url = backend.partition('=')
+    if (name, bool(url)) not in (('local', False), ('remote', True)):
+        raise ValueError(f"unknown backend {backend!r}, expected local or remote=<url>")
+    return name, url if not url or url.endswith('/') else url + '/'
+
+
+def main(revid, backends=('local',), n_articles=5000, repeats=5):
+    backends = [parse_backend(backend) for backend in backends]
+    data = get_training_data(revid, with_manscreen=True)
+    articles = newest_articles(n_articles)
+    print(f"{revid}: {len(data)} labelled articles, scoring {len(articles)}")
+
+    with tempfile.TemporaryDirectory() as model_root:
+        for backend, url in backends:
+            screener = LocalScreener(model_root) if backend == 'local' else RemoteScreener(url)
+            try:
+                result = bench(screener, revid, data, articles, repeats)
+            except Exception as e:
+                print(f"{backend:8} failed: {e!r}")
+                continue
+            print(f"{backend:8} train {result['train']:8.2f}s  predict median {result['predict']:7.3f}s"
+                  f" (min {result['predict_min']:.3f}s)  {result['articles_per_second']:10.0f} articles/s")
+
+
+if __name__ == '__main__':
+    revid = sys.argv[1]
+    backends = tuple(sys.argv[2].split(',')) if len(sys.argv) > 2 else ('local',)
+    main(revid, backends, *(int(a) for a in sys.argv[3:5]))
@@ -0,0 +1,62 @@
+#
+#   COPY based bulk writes for the screening tables
+#
+
+import io
+import uuid
+from contextlib import closing
+
+from .database import engine
+
+
+def copy_into(cur, df, table, not_null=()):
+    """
+    streams the rows of df into table with COPY FROM STDIN, columns by name
+
+    empty fields (NaN/None, and '') are COPYed as NULL, except in the
+    columns not_null, where '' stays ''
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    options = "FORMAT csv"
+    if not_null:
+        options += f", FORCE_NOT_NULL ({', '.join(not_null)})"
+    cur.copy_expert(f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH ({options})", buf)
+
+
+def copy_upsert(conn, df, table, conflict=('revid', 'pmid')) -> dict:
+    """
+    COPYs df into a temporary staging table, then merges it into table with
+    INSERT ... ON CONFLICT DO NOTHING, so rows already there (e.g. from a
+    retried run) are skipped rather than duplicated
+
+    conn is a DBAPI (psycopg2) connection, committing is left to the caller
+    so the write can share a transaction with other statements
+    """
+    if df.shape[0] == 0:
+        return {"inserted": 0, "skipped": 0}
+
+    stage = f"stage_{table}_{uuid.uuid4().hex[:8]}"
+    cols = ', '.join(df.columns)
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS SELECT {cols} FROM {table} WITH NO DATA;")
+        copy_into(cur, df, stage)
+        cur.execute(f"""INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage}
+                        ON CONFLICT ({', '.join(conflict)}) DO NOTHING;""")
+        inserted = cur.rowcount
+        cur.execute(f"DROP TABLE {stage};")
+    return {"inserted": inserted, "skipped": df.shape[0] - inserted}
+
+
+def upsert_table(df, table, conflict=('revid', 'pmid')) -> dict:
+    # copy_upsert in a transaction of its own
+    with closing(engine.raw_connection()) as conn:
+        try:
+            counts = copy_upsert(conn, df, table, conflict)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    print(f"{table}: {counts['inserted']} rows inserted, {counts['skipped']} skipped")
+    return counts
@@ -10,13 +10,24 @@ import numpy as np
 import requests
 import json
 import datetime
-from .database import engine
+import time
+from contextlib import closing
+from .database import engine, ensure_update_schema
+from .bulk import copy_upsert, upsert_table
+from .screener import CONNECT_TIMEOUT, PREDICT_TIMEOUT
+from .watermark import new_rcts_query, start_key, update_watermark
+
+# number of pubmed rows pulled from the server side cursor at a time
+CHUNKSIZE = 5000
 
 
 def get_baseline_meta() -> dict:
-    return {"last_updated": pd.read_sql("select * from revmeta where revid='covax';", engine).last_updated[0],
-            "done_manual": set(pd.read_sql("select pmid from manscreen where revid='covax';", engine).pmid.values),
-            "done_auto": set(pd.read_sql("select pmid from autoscreen where revid='covax';", engine).pmid.values)}
+    # already screened pmids are excluded inside the query in get_new_rcts
+    meta = engine.execute("select last_updated, watermark_date, watermark_pmid from revmeta where revid='covax';").fetchone()
+    watermark = None
+    if meta.watermark_date is not None:
+        watermark = (meta.watermark_date, meta.watermark_pmid)
+    return {"last_updated": meta.last_updated, "watermark": watermark}
 
 # this can be adapted to any topic filter kewword list
 covid_filter = ["2019 ncov",
@@ -46,68 +57,97 @@ def is_covid(text) -> bool:
     return any((syn in text.lower() for syn in covid_filter))
 
 
-def get_new_rcts(last_updated):
-    # get all RCTs since the last classification date
-    sql = f"""SELECT pmid, ti, ab FROM pubmed WHERE is_rct_balanced=true and
-              update_date>='{last_updated.strftime('%Y-%m-%d')}'::date and year>=2020;"""
-    updates = pd.read_sql(sql, engine)
+# all RCTs from 2020 on after covax's watermark that are not yet in its
+# manscreen/autoscreen, in (update_date, pmid) order (see app.watermark)
+MIN_YEAR = 2020
+
+def get_new_rcts(after):
+    sql, params = new_rcts_query(after, 'covax', MIN_YEAR)
+    updates = pd.read_sql(sql, engine, params=params)
     return updates
 
+def iter_new_rcts(after, chunksize=CHUNKSIZE):
+    # same as get_new_rcts, streamed from a server side cursor a chunk at a time
+    sql, params = new_rcts_query(after, 'covax', MIN_YEAR)
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(sql, conn, params=params, chunksize=chunksize):
+            # newer pandas yields one empty frame when there are no rows
+            if chunk.empty:
+                continue
+            yield chunk
+
 def filter_topic(df) -> pd.DataFrame:
     return df[(df.ti + ' ' + df.ab).apply(is_covid)]
 
-def filter_new(df, done_manual, done_auto) -> pd.DataFrame:
-    return df[df['pmid'].apply(lambda x: (x not in done_manual) and (x not in done_auto))]
-
 def get_api_json(df) -> list:
-    return [{"ti": r.ti, "abs": r.ab} for (i, r) in df.iterrows()]
+    return [{"ti": ti, "abs": ab} for (ti, ab) in zip(df.ti, df.ab)]
 
 def fetch_preds(articles_list) -> list:
     base_url="http://127.0.0.1:5000/"
     headers = {'Content-Type': 'application/json', 'Accept':'application/json'}
-    predictions = requests.post(base_url+'predict/vaccine_model', json=json.dumps({"input_citations": articles_list}), headers=headers)
+    predictions = requests.post(base_url+'predict/vaccine_model', json=json.dumps({"input_citations": articles_list}), headers=headers,
+                                timeout=(CONNECT_TIMEOUT, PREDICT_TIMEOUT))
     return predictions.json()
 
 
-def update_autoscreen_table(df):
-    df.to_sql('autoscreen', engine, if_exists='append', index=False)
+def update_autoscreen_table(df) -> dict:
+    return upsert_table(df, 'autoscreen')
 
 
-def update_manscreen_table(df):
-    df.to_sql('manscreen', engine, if_exists='append', index=False)
+def update_manscreen_table(df) -> dict:
+    return upsert_table(df, 'manscreen')
 
 
 def update_last_updated():
     engine.execute("UPDATE revmeta SET last_updated = (%s) WHERE revid = 'covax'", (datetime.date.today(),))
 
+def screen_and_save(updates, meta):
+    # the chunk's writes commit together with the watermark moved to its
+    # last (update_date, pmid), so a stopped run resumes after it
+    last = updates.iloc[-1]
+    last_key = (last.update_date, str(last.pmid))
+    updates_filtered = filter_topic(updates)
+    if updates_filtered.shape[0] > 0:
+        articles_list = get_api_json(updates_filtered)
+        preds = fetch_preds(articles_list)
+    with closing(engine.raw_connection()) as conn:
+        try:
+            if updates_filtered.shape[0] > 0:
+                # set up table for saving in DB
+                updates_filtered = updates_filtered[['pmid']].copy()
+                updates_filtered['revid'] = 'covax' 
+                updates_filtered['score'] = preds['predictions']
+                updates_filtered['decision'] = updates_filtered['score'] >= 0.5    
+                copy_upsert(conn, updates_filtered, 'autoscreen')
+
+                man = updates_filtered[updates_filtered.decision==True].drop(['decision', 'score'], axis=1)
+                man['decision'] = None
+                man['login'] = None
+                man['in_live_update'] = True # by default new studies are included up until they are incorporated in the review
+                copy_upsert(conn, man, 'manscreen')
+            update_watermark(conn, 'covax', last_key)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
 def main():
     # *** main loop ***
     
+    ensure_update_schema()
     meta = get_baseline_meta()
-    updates = get_new_rcts(meta['last_updated'])
-    if updates.shape[0] == 0:
+    n = 0
+    started = time.time()
+    for n, updates in enumerate(iter_new_rcts(start_key(meta)), 1):
+        screen_and_save(updates, meta)
+        elapsed = time.time() - started
+        print(f"chunk {n}: {updates.shape[0]} rows in {elapsed:.1f}s ({updates.shape[0] / max(elapsed, 1e-6):.0f} rows/s)")
+        started = time.time()
+    if n == 0:
         print("no new trials - exiting")
         quit()
-    updates_filtered = filter_new(filter_topic(updates), meta['done_manual'], meta['done_auto'])
-    articles_list = get_api_json(updates_filtered)
-    preds = fetch_preds(articles_list)
-    # set up table for saving in DB
-
-    updates_filtered.drop(['ti', 'ab'], axis=1, inplace=True)
-    updates_filtered['revid'] = 'covax' 
-    updates_filtered['score'] = preds['predictions']
-    updates_filtered['decision'] = updates_filtered['score'] >= 0.5    
-    update_autoscreen_table(updates_filtered)
-
-    man = updates_filtered[updates_filtered.decision==True].drop(['decision', 'score'], axis=1)
-    man['decision'] = None
-    man['login'] = None
-    man['in_live_update'] = True # by default new studies are included up until they are incorporated in the review
-    update_manscreen_table(man)
     update_last_updated()
 
 
 if __name__ == '__main__':
     main()
-
-
@@ -0,0 +1,67 @@
+#
+#   topic filter: does a text mention every CUI of a review (any synonym of
+#   each), per text with is_cui or over a Series with a compiled matcher
+#
+#   the matcher is one Aho-Corasick automaton over the synonyms of all the
+#   CUIs it is built for, so each lowercased text is scanned once however
+#   many CUIs (and synonyms) there are, and the scan reports which CUIs hit
+#
+
+import pandas as pd
+
+
+def is_cui(text, strlists):
+    return all((any((syn in text.lower() for syn in strlist)) for strlist in strlists))
+
+
+class CuiMatcher:
+    """
+    strlists is a list of synonym lists, one per CUI; groups_in(text) is the
+    set of positions in it with a synonym in the lowercased text, i.e. the
+    CUIs for which the any(...) in is_cui holds
+    """
+
+    def __init__(self, strlists):
+        import ahocorasick
+
+        self.n_groups = len(strlists)
+        # '' is in every text, an empty list in none (any([]) is False)
+        self.always = frozenset(i for i, strlist in enumerate(strlists) if '' in strlist)
+        groups_by_syn = {}
+        for i, strlist in enumerate(strlists):
+            for syn in strlist:
+                if syn:
+                    groups_by_syn.setdefault(syn, set()).add(i)
+
+        self._automaton = None
+        if groups_by_syn:
+            self._automaton = ahocorasick.Automaton()
+            for syn, groups in groups_by_syn.items():
+                self._automaton.add_word(syn, frozenset(groups))
+            self._automaton.make_automaton()
+
+    def groups_in(self, text) -> set:
+        found = set(self.always)
+        if self._automaton is not None:
+            for _, groups in self._automaton.iter(text.lower()):
+                found |= groups
+                if len(found) == self.n_groups:
+                    break
+        return found
+
+
+def compile_matcher(strlists) -> CuiMatcher:
+    return CuiMatcher([list(strlist) for strlist in strlists])
+
+
+def match_cui(texts, matcher) -> pd.Series:
+    """
+    bulk version of is_cui over a Series of texts: one automaton scan per
+    text, a text matches when every CUI of the matcher is found
+    """
+    n = matcher.n_groups
+    if n == 0:
+        # no CUIs, all([]) is True
+        return pd.Series(True, index=texts.index)
+    return pd.Series([isinstance(text, str) and len(matcher.groups_in(text)) == n for text in texts],
+                     index=texts.index, dtype=bool)
@@ -0,0 +1,91 @@
+#
+#   on-disk CUI -> synonym list store, replacing the strlist_from_cui.pck
+#   pickle that had to be loaded whole
+#
+#   build from the pickle with:
+#       python -m app.cui_store [strlist_from_cui.pck] [strlist_from_cui.idx]
+#
+
+import json
+import os
+import pickle
+import sys
+
+import app
+from .mmap_index import MmapIndex, write_index
+
+STORE_PATH = os.path.join(app._ROOT, 'strlist_from_cui.idx')
+PICKLE_PATH = os.path.join(app._ROOT, 'strlist_from_cui.pck')
+
+
+class CuiStore:
+    """
+    read only dict-like view of the synonym store, each CUI is decoded the
+    first time it is asked for and kept for the life of the process
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.index = MmapIndex(path)
+        self._cache = {}
+
+    def __getitem__(self, cui) -> list:
+        if cui not in self._cache:
+            value = self.index.get(cui)
+            if value is None:
+                raise KeyError(cui)
+            self._cache[cui] = json.loads(value)
+        return self._cache[cui]
+
+    def get(self, cui, default=None):
+        try:
+            return self[cui]
+        except KeyError:
+            return default
+
+    def __contains__(self, cui) -> bool:
+        return cui in self._cache or cui in self.index
+
+
+class PickleStore:
+    """
+    fallback while the store has not been built: the old pickle, but only
+    unpickled on the first lookup rather than at import
+    """
+
+    def __init__(self, path=PICKLE_PATH):
+        self.path = path
+        self._data = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                self._data = pickle.load(f)
+        return self._data
+
+    def __getitem__(self, cui) -> list:
+        return self._load()[cui]
+
+    def get(self, cui, default=None):
+        return self._load().get(cui, default)
+
+    def __contains__(self, cui) -> bool:
+        return cui in self._load()
+
+
+def open_store(store_path=STORE_PATH, pickle_path=PICKLE_PATH):
+    if os.path.exists(store_path):
+        return CuiStore(store_path)
+    print(f"{store_path} not found, falling back to {pickle_path} (build it with python -m app.cui_store)")
+    return PickleStore(pickle_path)
+
+
+def build(pickle_path=PICKLE_PATH, store_path=STORE_PATH):
+    with open(pickle_path, 'rb') as f:
+        strlist_from_cui = pickle.load(f)
+    write_index(store_path, ((cui, json.dumps(list(strlist)).encode('utf-8'))
+                             for cui, strlist in strlist_from_cui.items()))
+    print(f"wrote {len(strlist_from_cui)} CUIs to {store_path}")
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:3])
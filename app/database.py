@@ -1,18 +1,61 @@
 from typing import Generator
 
 from sqlalchemy import MetaData, create_engine, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from app.settings import settings
+from app.metrics import register_pool, timed_pool
 
 SQLALCHEMY_DATABASE_URL = settings.db_uri
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# the sqlalchemy defaults, spelled out so they show up next to the pool metrics
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=timed_pool(QueuePool, "sync"),
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+)
+register_pool(engine, "sync")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async (asyncpg) engine with its own pool for the read heavy API endpoints,
+# waiting for a connection here parks a coroutine rather than a thread.
+# Created on first use, so the update scripts never load asyncpg
+ASYNC_POOL_SIZE = 20
+ASYNC_MAX_OVERFLOW = 20
+
+_async_engine = None
+_async_sessionmaker = None
+
+
+def get_async_engine():
+    global _async_engine, _async_sessionmaker
+    if _async_engine is None:
+        _async_engine = create_async_engine(
+            make_url(SQLALCHEMY_DATABASE_URL).set(drivername="postgresql+asyncpg"),
+            poolclass=timed_pool(AsyncAdaptedQueuePool, "async"),
+            pool_size=ASYNC_POOL_SIZE,
+            max_overflow=ASYNC_MAX_OVERFLOW,
+        )
+        register_pool(_async_engine.sync_engine, "async")
+        _async_sessionmaker = sessionmaker(_async_engine, class_=AsyncSession, expire_on_commit=False)
+    return _async_engine
+
+
+def async_session() -> AsyncSession:
+    get_async_engine()
+    return _async_sessionmaker()
+
 meta = MetaData(
     naming_convention={
         "ix": "ix_%(column_0_N_label)s",
@@ -39,6 +82,132 @@ class Base(SQLBase):
         }
 
 
+# indexes/columns for tables which are not (fully) managed by the ORM models:
+# SCHEMA_DDL is applied by ensure_schema at startup of the API and the update
+# scripts, what only the update scripts need by ensure_update_schema when
+# they start
+
+# needed by the ON CONFLICT (revid, pmid) merge in app.bulk: (name, table).
+# A table which already has duplicated (revid, pmid) rows cannot get its
+# index, those are reported and removed by python -m app.dedupe_screening
+UNIQUE_INDEXES = [
+    ("uq_autoscreen_revid_pmid", "autoscreen"),
+    ("uq_manscreen_revid_pmid", "manscreen"),
+]
+
+SCHEMA_DDL = [
+    # pending (not yet screened) articles per review, for the dashboard counts
+    # and the screening queue
+    "CREATE INDEX IF NOT EXISTS ix_manscreen_pending ON manscreen (revid, pmid) WHERE decision IS NULL;",
+    "CREATE INDEX IF NOT EXISTS ix_permissions_login_revid ON permissions (login, revid);",
+    # hash of the labelled data the review's screener model was trained on
+    "ALTER TABLE revmeta ADD COLUMN IF NOT EXISTS train_fingerprint text;",
+    # the (update_date, pmid) of pubmed each review has been updated up to
+    "ALTER TABLE revmeta ADD COLUMN IF NOT EXISTS watermark_date date;",
+    "ALTER TABLE revmeta ADD COLUMN IF NOT EXISTS watermark_pmid text;",
+    # app.summary_cache
+    """CREATE TABLE IF NOT EXISTS summary_cache (
+           key text PRIMARY KEY,
+           updated_summary text NOT NULL,
+           created_at timestamptz NOT NULL DEFAULT now(),
+           used_at timestamptz NOT NULL DEFAULT now());""",
+    "CREATE INDEX IF NOT EXISTS ix_summary_cache_used_at ON summary_cache (used_at);",
+    # pmids already folded into each review's automated narrative summary
+    """CREATE TABLE IF NOT EXISTS summary_pmids (
+           revid text NOT NULL,
+           pmid text NOT NULL,
+           PRIMARY KEY (revid, pmid));""",
+]
+
+
+# built CONCURRENTLY by ensure_update_schema, so ingestion keeps writing to
+# the (large) tables while they are built: (name, CREATE INDEX statement)
+UPDATE_INDEXES = [
+    # the order the update scripts scan pubmed in from the watermarks
+    ("ix_pubmed_rct_update_date_pmid",
+     """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pubmed_rct_update_date_pmid
+            ON pubmed (update_date, (pmid COLLATE "C")) WHERE is_rct_balanced = true;"""),
+]
+# held while the update schema is applied, one process at a time
+UPDATE_SCHEMA_LOCK = 72550601
+
+
+def ensure_unique_index(conn, name, table):
+    if conn.execute("SELECT to_regclass(%s);", (name,)).scalar() is not None:
+        return
+    # the lock conflicts with itself, so processes starting together build
+    # the index one after the other and the later ones find it there
+    conn.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;")
+    try:
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} (revid, pmid);")
+    except IntegrityError as e:
+        raise RuntimeError(f"{table} has duplicated (revid, pmid) rows, "
+                           f"see python -m app.dedupe_screening") from e
+
+
+# the pubmed column types the revmeta watermark (watermark_date date,
+# watermark_pmid text) and the keyset scan in app.watermark are written for
+WATERMARK_COLUMN_TYPES = {"update_date": ("date",), "pmid": ("text", "character varying")}
+
+
+def check_watermark_columns(conn):
+    types = dict(conn.execute("""SELECT attname, atttypid::regtype::text FROM pg_attribute
+        WHERE attrelid = to_regclass('pubmed') AND attname = ANY(%(columns)s) AND NOT attisdropped;""",
+        {"columns": list(WATERMARK_COLUMN_TYPES)}).fetchall())
+    for column, expected in WATERMARK_COLUMN_TYPES.items():
+        if types.get(column) not in expected:
+            raise RuntimeError(f"pubmed.{column} is {types.get(column) or 'missing'}, "
+                               f"the update watermark needs {' or '.join(expected)}")
+
+
+def ensure_index(conn, name, ddl):
+    # a CONCURRENTLY build which failed leaves an invalid index behind,
+    # which IF NOT EXISTS would then keep, so it is dropped and built again
+    valid = conn.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (name,)).scalar()
+    if valid is False:
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    conn.execute(ddl)
+
+
+def ensure_schema(bind=None):
+    """
+    applies SCHEMA_DDL, raising on the first failure
+    """
+    bind = engine if bind is None else bind
+    for ddl in SCHEMA_DDL:
+        try:
+            with bind.begin() as conn:
+                conn.execute(ddl)
+        except Exception as e:
+            raise RuntimeError(f"could not apply {ddl!r}") from e
+
+
+def ensure_update_schema(bind=None):
+    """
+    what the update scripts need on top of ensure_schema: checks the pubmed
+    columns the watermark is compared with, then builds UNIQUE_INDEXES and
+    UPDATE_INDEXES, raising on the first failure
+    """
+    bind = engine if bind is None else bind
+    with bind.connect() as conn:
+        check_watermark_columns(conn)
+    ensure_schema(bind)
+    for name, table in UNIQUE_INDEXES:
+        with bind.begin() as conn:
+            ensure_unique_index(conn, name, table)
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute("SELECT pg_advisory_lock(%s);", (UPDATE_SCHEMA_LOCK,))
+        try:
+            for name, ddl in UPDATE_INDEXES:
+                try:
+                    ensure_index(conn, name, ddl)
+                except Exception as e:
+                    raise RuntimeError(f"could not apply {ddl!r}") from e
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s);", (UPDATE_SCHEMA_LOCK,))
+
+
 # Dependency
 def get_db() -> Generator[Session, None, None]:
     db = SessionLocal()
@@ -48,3 +217,8 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with async_session() as db:
+        yield db
@@ -0,0 +1,92 @@
+#
+#   one-off migration for databases written before the (revid, pmid) unique
+#   indexes on autoscreen and manscreen: lists the duplicated rows and, with
+#   --delete, removes the ones which can be dropped without losing a decision
+#
+#   python -m app.dedupe_screening            report only, changes nothing
+#   python -m app.dedupe_screening --delete   delete, then build the indexes
+#
+#   In manscreen a pmid screened once and also left pending keeps the
+#   screened row. Two different screening decisions (decision, login) for
+#   the same (revid, pmid) are conflicts: they are listed, never deleted,
+#   and the index cannot be built until they are resolved by hand. In
+#   autoscreen the rows are model predictions and the most positive one
+#   (the one which put the article in manscreen) is kept.
+#
+
+import sys
+
+from .database import UNIQUE_INDEXES, engine, ensure_unique_index
+
+# (which duplicate to keep first, what makes two duplicates a conflict)
+DEDUPE = {
+    "autoscreen": ("decision DESC NULLS LAST, score DESC NULLS LAST, ctid", None),
+    "manscreen": ("(decision IS NULL), ctid", "(decision, login)"),
+}
+# conflicting groups printed in full, the rest are only counted
+SHOW_CONFLICTS = 50
+
+
+def duplicates_sql(table) -> str:
+    _, conflict = DEDUPE[table]
+    n_conflicting = "0" if conflict is None else f"count(DISTINCT {conflict}) FILTER (WHERE decision IS NOT NULL)"
+    return f"""SELECT revid, pmid, count(*) AS n_rows, {n_conflicting} AS n_decisions
+               FROM {table} GROUP BY revid, pmid HAVING count(*) > 1"""
+
+
+def report(conn, table) -> list:
+    """prints the duplicated (revid, pmid) of table, returns the conflicting ones"""
+    groups = conn.execute(duplicates_sql(table) + ";").fetchall()
+    conflicts = [g for g in groups if g.n_decisions > 1]
+    extra = sum(g.n_rows - 1 for g in groups)
+    print(f"{table}: {len(groups)} duplicated (revid, pmid), {extra} extra rows, {len(conflicts)} conflicting")
+    for g in conflicts[:SHOW_CONFLICTS]:
+        rows = conn.execute(f"SELECT * FROM {table} WHERE revid = %s AND pmid = %s ORDER BY ctid;", (g.revid, g.pmid)).fetchall()
+        print(f"  conflict {g.revid} {g.pmid}:")
+        for row in rows:
+            print(f"    {dict(row)}")
+    if len(conflicts) > SHOW_CONFLICTS:
+        print(f"  ... and {len(conflicts) - SHOW_CONFLICTS} more conflicts")
+    return conflicts
+
+
+def delete_duplicates(conn, table) -> int:
+    """deletes the duplicates of table which are not conflicts, returns how many"""
+    keep, _ = DEDUPE[table]
+    # no writes between finding the duplicates and deleting them
+    conn.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE;")
+    return conn.execute(f"""WITH dup AS ({duplicates_sql(table)})
+        DELETE FROM {table} WHERE ctid IN (
+            SELECT d.ctid FROM (SELECT ctid, revid, pmid,
+                row_number() OVER (PARTITION BY revid, pmid ORDER BY {keep}) AS n FROM {table}) AS d
+            JOIN dup ON dup.revid = d.revid AND dup.pmid = d.pmid
+            WHERE d.n > 1 AND dup.n_decisions <= 1);""").rowcount
+
+
+def main(delete=False, bind=None) -> bool:
+    """
+    returns whether every table is free of duplicates (and, with delete,
+    has its unique index)
+    """
+    bind = engine if bind is None else bind
+    clean = True
+    for name, table in UNIQUE_INDEXES:
+        with bind.begin() as conn:
+            conflicts = report(conn, table)
+            if not delete:
+                clean = clean and conn.execute(duplicates_sql(table) + " LIMIT 1;").fetchone() is None
+                continue
+            removed = delete_duplicates(conn, table)
+            print(f"{table}: deleted {removed} duplicate rows")
+        if conflicts:
+            print(f"{table}: resolve the conflicts above, then run this again to build {name}")
+            clean = False
+            continue
+        with bind.begin() as conn:
+            ensure_unique_index(conn, name, table)
+        print(f"{table}: {name} built")
+    return clean
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(delete='--delete' in sys.argv) else 1)
@@ -4,15 +4,39 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .api.routes import router as api_router
+from .api.storage import UploadLimitMiddleware, get_storage
+from .database import SQLBase, engine, ensure_schema
+from .metrics import RequestTimingMiddleware
+from .profiling import ProfilerMiddleware
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+def create_schema():
+    # create tables if not exist
+    SQLBase.metadata.create_all(engine)
+    ensure_schema(engine)
+    # a misconfigured RRLIVE_UPLOAD_STORAGE fails here, not on the first upload
+    get_storage()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # the name of the profile written for a profiled request
+    expose_headers=["X-Profile"],
 )
 
 app.include_router(api_router, prefix="/api")
+
+# a pass through unless RRLIVE_PROFILE_TOKEN is set, see app/profiling.py
+app.add_middleware(ProfilerMiddleware)
+# 413 for oversized CSV uploads before they are spooled to disk
+app.add_middleware(UploadLimitMiddleware)
+
+# outermost, so it times the other middlewares too
+app.add_middleware(RequestTimingMiddleware)
@@ -0,0 +1,136 @@
+#
+#   prometheus metrics: db pool, named query, summarizer and request latency
+#   (served as text by /api/metrics to scrapers sending
+#   Authorization: Bearer $RRLIVE_METRICS_TOKEN, one registry per worker process)
+#
+
+import asyncio
+import functools
+import hmac
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    'rrlive_db_pool_checkout_seconds', 'Time spent waiting for a connection from the pool', ['pool'])
+POOL_IN_USE = Gauge(
+    'rrlive_db_pool_connections_in_use', 'Connections currently checked out of the pool', ['pool'])
+POOL_OVERFLOW = Gauge(
+    'rrlive_db_pool_overflow', 'Connections open beyond pool_size (negative while the pool is not full)', ['pool'])
+QUERY_SECONDS = Histogram(
+    'rrlive_query_seconds', 'Latency of named queries', ['query'])
+REQUEST_SECONDS = Histogram(
+    'rrlive_request_seconds', 'Request latency per route', ['method', 'route', 'status'])
+# outbound calls to the summarization service, kept out of the query histogram
+SUMMARIZER_SECONDS = Histogram(
+    'rrlive_summarizer_seconds', 'Latency of calls to the summarizer service', ['endpoint'],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
+METRICS_TOKEN = os.environ.get('RRLIVE_METRICS_TOKEN') or None
+
+
+def timed_pool(base, label):
+    """
+    subclass of the pool class `base` which records how long each checkout
+    waited; recreate() builds from self.__class__, so the label survives
+    """
+    class TimedPool(base):
+        metrics_label = label
+
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                POOL_CHECKOUT_SECONDS.labels(self.metrics_label).observe(time.perf_counter() - started)
+
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+
+def register_pool(engine, label):
+    # read at scrape time, engine.pool is looked up each time as dispose() replaces it
+    POOL_IN_USE.labels(label).set_function(lambda: engine.pool.checkedout())
+    POOL_OVERFLOW.labels(label).set_function(lambda: engine.pool.overflow())
+
+
+def timed_query(fn):
+    """
+    records the latency of fn under its module and name, e.g. crud.get_user
+    """
+    hist = QUERY_SECONDS.labels(f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}")
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def timed_async(*args, **kwargs):
+            with hist.time():
+                return await fn(*args, **kwargs)
+        return timed_async
+
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        with hist.time():
+            return fn(*args, **kwargs)
+    return timed
+
+
+def route_template(scope) -> str:
+    # label by route template (/api/get_screenlist/{revid}) not the raw path
+    from starlette.routing import Match
+
+    for route in scope['app'].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class RequestTimingMiddleware:
+    """
+    records REQUEST_SECONDS per method, route template and status, up to the
+    last chunk of the body being sent (a streamed response is timed to its end)
+    """
+
+    # starlette builds middleware as cls(app=..., **options)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        started = time.perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            observed = True
+            REQUEST_SECONDS.labels(scope['method'], route, str(status)).observe(time.perf_counter() - started)
+
+        async def timed_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False) and not observed:
+                observe()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            # an error or a disconnect before the body was complete
+            if not observed:
+                observe()
+
+
+def is_authorised(token) -> bool:
+    # nobody can read the metrics while RRLIVE_METRICS_TOKEN is unset
+    return METRICS_TOKEN is not None and token is not None and hmac.compare_digest(token, METRICS_TOKEN)
+
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,90 @@
+#
+#   read-only, memory-mapped sorted key -> bytes index
+#
+#   layout:  header (magic, version, count)
+#            count x uint64 offsets of the entries, in key order
+#            entries: uint32 key length, uint32 value length, key, value
+#
+#   the file is only ever mmapped read-only, so every process opening it
+#   shares the same pages from the OS page cache
+#
+
+import mmap
+import os
+import struct
+
+MAGIC = b'RRIX'
+VERSION = 1
+_HEADER = struct.Struct('<4sIQ')
+_OFFSET = struct.Struct('<Q')
+_ENTRY = struct.Struct('<II')
+
+
+def write_index(path, items):
+    """
+    writes (str key, bytes value) pairs to path; the new file is moved into
+    place at the end so readers never see a half written index
+    """
+    entries = sorted((k.encode('utf-8'), v) for k, v in items)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(entries)))
+        offset = _HEADER.size + _OFFSET.size * len(entries)
+        for k, v in entries:
+            f.write(_OFFSET.pack(offset))
+            offset += _ENTRY.size + len(k) + len(v)
+        for k, v in entries:
+            f.write(_ENTRY.pack(len(k), len(v)))
+            f.write(k)
+            f.write(v)
+    os.replace(tmp_path, path)
+
+
+class MmapIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._count = None
+
+    def _open(self):
+        if self._mm is None:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count = _HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{self.path} is not a version {VERSION} index")
+            self._mm, self._count = mm, count
+        return self._mm
+
+    def __len__(self) -> int:
+        self._open()
+        return self._count
+
+    def _entry(self, i):
+        mm = self._mm
+        (offset,) = _OFFSET.unpack_from(mm, _HEADER.size + _OFFSET.size * i)
+        klen, vlen = _ENTRY.unpack_from(mm, offset)
+        start = offset + _ENTRY.size
+        return mm[start:start + klen], start + klen, vlen
+
+    def get(self, key, default=None):
+        """
+        binary search for key, only touches the pages on the search path
+        """
+        self._open()
+        target = key.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, start, vlen = self._entry(mid)
+            if k == target:
+                return self._mm[start:start + vlen]
+            if k < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return default
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
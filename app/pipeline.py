@@ -0,0 +1,156 @@
+#
+#   bounded filter -> predict -> persist pipeline for the update scripts
+#
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def _put(q, item, stop) -> bool:
+    # blocks while the queue is full (back-pressure), gives up once stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _acquire(sem, stop) -> bool:
+    while not stop.is_set():
+        if sem.acquire(timeout=0.1):
+            return True
+    return False
+
+
+def _produce(source, outbox, stop, errors, in_flight):
+    # a batch is only read from source once a slot in in_flight is free, the
+    # slot is given back when the batch has been persisted
+    try:
+        batches = iter(source)
+        seq = 0
+        while _acquire(in_flight, stop):
+            try:
+                batch = next(batches)
+            except StopIteration:
+                in_flight.release()
+                break
+            if not _put(outbox, (seq, batch), stop):
+                return
+            seq += 1
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    _put(outbox, _DONE, stop)
+
+
+def _run_stage(fn, inbox, outbox, workers, stop, errors) -> threading.Thread:
+    """
+    runs fn over every (seq, batch) from inbox on `workers` threads, passing
+    (seq, fn(batch)) on to outbox, then a single _DONE once all have finished
+    """
+    def work():
+        while True:
+            item = _get(inbox, stop)
+            if item is _DONE:
+                # hand the sentinel on to the sibling workers
+                _put(inbox, _DONE, stop)
+                return
+            seq, batch = item
+            try:
+                result = fn(batch)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                return
+            if not _put(outbox, (seq, result), stop):
+                return
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+
+    def close():
+        for t in threads:
+            t.join()
+        _put(outbox, _DONE, stop)
+
+    closer = threading.Thread(target=close, daemon=True)
+    closer.start()
+    return closer
+
+
+def run_pipeline(source, filter_fn, predict_fn, persist_fn, queue_size=4,
+                 filter_workers=1, predict_workers=2, persist_workers=1) -> int:
+    """
+    runs batches from source through filter_fn, predict_fn and persist_fn at
+    the same time, with a bounded queue between each stage
+
+    a full queue blocks the stage feeding it, so at most about queue_size
+    batches wait in front of each stage, and at most queue_size plus the
+    number of workers have been read from source and not yet persisted, so
+    a batch held up in one stage does not let the rest of the source be read
+    ahead of it. With persist_workers=1 (the default) persist_fn is called
+    in this thread with batches in source order, whatever order the filter
+    and predict workers finish them in. The first exception raised by any
+    stage stops the pipeline and is re-raised here.
+
+    returns the number of batches persisted
+    """
+    stop = threading.Event()
+    errors = []
+    to_filter = queue.Queue(maxsize=queue_size)
+    to_predict = queue.Queue(maxsize=queue_size)
+    to_persist = queue.Queue(maxsize=queue_size)
+    in_flight = threading.Semaphore(queue_size + filter_workers + predict_workers + persist_workers)
+
+    producer = threading.Thread(target=_produce, args=(source, to_filter, stop, errors, in_flight), daemon=True)
+    producer.start()
+    stages = [_run_stage(filter_fn, to_filter, to_predict, filter_workers, stop, errors),
+              _run_stage(predict_fn, to_predict, to_persist, predict_workers, stop, errors)]
+
+    done = 0
+    if persist_workers > 1:
+        persisted = queue.Queue()
+        stages.append(_run_stage(persist_fn, to_persist, persisted, persist_workers, stop, errors))
+        while _get(persisted, stop) is not _DONE:
+            in_flight.release()
+            done += 1
+    else:
+        # re-order buffer: holds batches which finished ahead of an earlier one
+        pending = {}
+        while True:
+            item = _get(to_persist, stop)
+            if item is _DONE:
+                break
+            seq, batch = item
+            pending[seq] = batch
+            while done in pending:
+                try:
+                    persist_fn(pending.pop(done))
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+                    break
+                in_flight.release()
+                done += 1
+
+    stop.set()
+    producer.join()
+    for t in stages:
+        t.join()
+    if errors:
+        raise errors[0]
+    return done
@@ -0,0 +1,116 @@
+#
+#   on-demand sampling profiler for production requests
+#
+#   a request is profiled when it carries X-Profile-Token matching
+#   RRLIVE_PROFILE_TOKEN, or when its path starts with one of the profiled
+#   routes and it falls in the sampled fraction (both settable at runtime
+#   through /api/profiler). Each profile is written to app.PROFILE_ROOT as a
+#   speedscope (flamegraph) json file, named in the X-Profile response header;
+#   only the newest PROFILE_KEEP files are kept.
+#
+#   pyinstrument samples the event loop thread with async_mode, so await
+#   time (SQL on the async engine, outbound httpx calls) shows up as wall
+#   clock; the work of sync endpoints shows as the await on the threadpool.
+#
+
+import glob
+import hmac
+import os
+import random
+import re
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+import app
+
+PROFILE_INTERVAL = 0.001
+# older profiles are deleted as new ones are written
+PROFILE_KEEP = int(os.environ.get('RRLIVE_PROFILE_KEEP', 200))
+
+
+class ProfilerConfig:
+
+    def __init__(self):
+        self.token = os.environ.get('RRLIVE_PROFILE_TOKEN') or None
+        self.routes = [r for r in os.environ.get('RRLIVE_PROFILE_ROUTES', '').split(',') if r]
+        self.sample_rate = float(os.environ.get('RRLIVE_PROFILE_SAMPLE_RATE', 0))
+
+    def is_authorised(self, token) -> bool:
+        return self.token is not None and token is not None and hmac.compare_digest(token, self.token)
+
+
+profiler_config = ProfilerConfig()
+
+
+def _header(scope, name: bytes):
+    for k, v in scope['headers']:
+        if k == name:
+            return v.decode('latin-1')
+    return None
+
+
+def profile_path(name) -> str:
+    # only file names made by ProfilerMiddleware, no directories
+    if not re.fullmatch(r'[\w.-]+\.speedscope\.json', name):
+        raise ValueError(name)
+    return os.path.join(app.PROFILE_ROOT, name)
+
+
+def save_profile(name, profiler, keep=PROFILE_KEEP):
+    from pyinstrument.renderers import SpeedscopeRenderer
+
+    os.makedirs(app.PROFILE_ROOT, exist_ok=True)
+    with open(profile_path(name), 'w') as f:
+        f.write(profiler.output(renderer=SpeedscopeRenderer()))
+
+    profiles = sorted(glob.glob(os.path.join(app.PROFILE_ROOT, '*.speedscope.json')), key=os.path.getmtime)
+    for path in profiles[:max(len(profiles) - keep, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another worker
+            pass
+
+
+class ProfilerMiddleware:
+
+    # starlette builds middleware as cls(app=..., **options)
+    def __init__(self, app, config=profiler_config):
+        self.app = app
+        self.config = config
+
+    def _wanted(self, scope) -> bool:
+        config = self.config
+        if config.token is None:
+            # nobody can be authorised to profile, skip all the checks
+            return False
+        if config.is_authorised(_header(scope, b'x-profile-token')):
+            return True
+        return (config.sample_rate > 0
+                and any(scope['path'].startswith(r) for r in config.routes)
+                and random.random() < config.sample_rate)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+
+        slug = re.sub(r'[^\w-]+', '_', scope['path']).strip('_')
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}-{slug}-{random.getrandbits(32):08x}.speedscope.json"
+
+        async def send_with_header(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(b'x-profile', name.encode('latin-1'))]
+            await send(message)
+
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode='enabled')
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            profiler.stop()
+            # rendering and the file write stay off the event loop
+            await run_in_threadpool(save_profile, name, profiler)
@@ -16,18 +16,39 @@ from typing import Counter
 import pickle
 # from mailjet_rest import Client
 import os
+import time
+import hashlib
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import app
 from typing import Generator
-from .database import engine
-
-screener_url = 'http://screen.robotreviewer.net/'
+from .database import engine, ensure_update_schema
+from .bulk import copy_upsert, upsert_table
+from .cui_store import open_store
+from .cui_filter import compile_matcher, match_cui
+from .pipeline import run_pipeline
+from .screener import get_screener
+from .watermark import after_key, new_rcts_query, start_key, update_watermark
+
+# number of pubmed rows pulled from the server side cursor at a time
+CHUNKSIZE = 5000
+
+# screener training runs in the background, this many at a time, and is
+# polled every TRAIN_POLL seconds while the other reviews are updated
+TRAIN_WORKERS = 2
+TRAIN_POLL = 5.0
+
+# filter -> predict -> persist pipeline settings (see app.pipeline)
+QUEUE_SIZE = 4
+FILTER_WORKERS = 1
+PREDICT_WORKERS = 2
+# must stay 1: chunks are persisted in scan order, each moving the
+# review's watermark forward in the same transaction as its writes
+PERSIST_WORKERS = 1
 
 # function zoo
-# Read pickle data
-#with open('strlist_from_cui.pck', 'rb') as f:  # for franks file
-with open(os.path.join(app._ROOT, 'strlist_from_cui.pck'), 'rb' ) as f:
-    # with open('../trialstreamer/strlist_from_cui.pck', 'rb') as f:
-    strlist_from_cui = pickle.load(f)
+# CUI -> synonyms, only the CUIs looked up are read (see app.cui_store)
+strlist_from_cui = open_store()
 
 # old is_covid filter
 
@@ -42,62 +63,91 @@ def filter_topic_covid(df) -> pd.DataFrame:
     return df[(df.ti + ' ' + df.ab).apply(is_covid)]
 
 
-def is_cui(text, strlists):
-    return all((any((syn in text.lower() for syn in strlist)) for strlist in strlists))
-
-
 def filter_topic_all(df) -> pd.DataFrame:
     return df[(df.ti + ' ' + df.ab).apply(is_important)]
 
 
-def filter_topic_all_cui(df, keyword_filter) -> pd.DataFrame:
+def compile_cui_matcher(keyword_filter):
+    """
+    builds the topic filter for a review once, one automaton over the
+    synonyms of all its CUIs
+    """
     cuis = [json.loads(i)['cui'] for i in keyword_filter]
-    strlists = [strlist_from_cui[c] for c in cuis]
-    return df[(df.ti + ' ' + df.ab).apply(lambda x: is_cui(x, strlists))]
+    return compile_matcher([strlist_from_cui[c] for c in cuis])
 
 
-def get_new_rcts(last_updated):
-    # get all RCTs since the last classification date
-    sql = f"""SELECT pmid, ti, ab FROM pubmed WHERE is_rct_balanced=true and
-              update_date>='{last_updated.strftime('%Y-%m-%d')}'::date;"""
-    updates = pd.read_sql(sql, engine)
+def filter_topic_all_cui(df, keyword_filter, matcher=None) -> pd.DataFrame:
+    if matcher is None:
+        matcher = compile_cui_matcher(keyword_filter)
+    return df[match_cui(df.ti + ' ' + df.ab, matcher)]
+
+
+def get_new_rcts(after, revid=None):
+    sql, params = new_rcts_query(after, revid)
+    updates = pd.read_sql(sql, engine, params=params)
     return updates
 
 
-def filter_new(df, done_manual, done_auto) -> pd.DataFrame:
-    return df[df['pmid'].apply(lambda x: (x not in done_manual) and (x not in done_auto))]
+def iter_new_rcts(after, revid=None, chunksize=CHUNKSIZE) -> Generator[pd.DataFrame, None, None]:
+    """
+    same rows as get_new_rcts, streamed from a server side cursor in chunks
+    of chunksize so memory use does not depend on the size of the backlog
+    """
+    sql, params = new_rcts_query(after, revid)
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(sql, conn, params=params, chunksize=chunksize):
+            # newer pandas yields one empty frame when there are no rows
+            if chunk.empty:
+                continue
+            yield chunk
+
+
+def drop_screened(df, revid) -> pd.DataFrame:
+    """
+    the same anti-join as new_rcts_query for articles which are already in
+    memory (the shared scan), only the candidate pmids are sent over
+    """
+    if df.shape[0] == 0:
+        return df
+    new = engine.execute("""SELECT c.pmid FROM unnest(%(pmids)s::text[]) AS c(pmid)
+        WHERE NOT EXISTS (SELECT 1 FROM manscreen AS ms WHERE ms.revid=%(revid)s AND ms.pmid=c.pmid)
+        AND NOT EXISTS (SELECT 1 FROM autoscreen AS au WHERE au.revid=%(revid)s AND au.pmid=c.pmid);""",
+        {"pmids": [str(pmid) for pmid in df.pmid], "revid": revid}).fetchall()
+    return df[df.pmid.astype(str).isin({i[0] for i in new})]
 
 
 def get_api_json(df) -> list:
-    return [{"ti": r.ti, "abs": r.ab} for (i, r) in df.iterrows()]
+    return [{"ti": ti, "abs": ab} for (ti, ab) in zip(df.ti, df.ab)]
 
 
 def fetch_preds(articles_list, revid) -> list:
-    headers = {'Content-Type': 'application/json',
-               'Accept': 'application/json'}
-    predictions = requests.post(f'{screener_url}predict/{revid}', json=json.dumps(
-        {"input_citations": articles_list}), headers=headers)
-    return predictions.json()
+    # RoboScreener, or the in-process model with SCREENER_BACKEND=local
+    return get_screener().predict(revid, articles_list)
 
 ####### UPDATES #########
 
 
-def update_autoscreen_table(df):
-    df.to_sql('autoscreen', engine, if_exists='append', index=False)
+def update_autoscreen_table(df) -> dict:
+    return upsert_table(df, 'autoscreen')
 
 
-def update_manscreen_table(df):
-    df.to_sql('manscreen', engine, if_exists='append', index=False)
+def update_manscreen_table(df) -> dict:
+    return upsert_table(df, 'manscreen')
 
 
 def update_last_updated(revid):
     engine.execute(
-        f"UPDATE revmeta SET last_updated = (%s) WHERE revid = '{revid}'", (date.today(),))
+        "UPDATE revmeta SET last_updated = (%s) WHERE revid = (%s)", (date.today(), revid))
 
 
 def update_is_trained(revid):
     engine.execute(
-        f"UPDATE revmeta SET is_trained = 1 WHERE revid = '{revid}'")
+        "UPDATE revmeta SET is_trained = 1 WHERE revid = (%s)", (revid,))
+
+
+def update_train_fingerprint(revid, fingerprint):
+    engine.execute(
+        "UPDATE revmeta SET is_trained = 1, train_fingerprint = %s WHERE revid = %s", (fingerprint, revid))
 
 
 def update_last_updated_all():
@@ -109,7 +159,7 @@ def update_last_updated_all():
 
 def get_base_data(revid) -> dict:
     revmeta_query = engine.execute(
-        "select last_updated, is_trained, keyword_filter, summary_update_needed from revmeta where revid=(%s);", (revid,)).fetchone()
+        "select last_updated, watermark_date, watermark_pmid, is_trained, train_fingerprint, keyword_filter, summary_update_needed from revmeta where revid=(%s);", (revid,)).fetchone()
     last_updated = revmeta_query.last_updated
 
     keyword_filter = engine.execute(
@@ -121,147 +171,361 @@ def get_base_data(revid) -> dict:
     # autoscreen — model predicted possibly relevant new studies for the living review
     # manscreen — manual validated studies (i.e. bow autoscreen studies which have gone on for
     # .             further review, and been assessed as relevant)
-
-    done_manual = engine.execute(
-        "select pmid from manscreen where revid=(%s);", (revid,)).fetchall()
-    done_manual = [i[0] for i in done_manual]  # convert tuple to values
-
-    done_auto = engine.execute(
-        "select pmid from autoscreen where revid=(%s);", (revid,)).fetchall()
-    done_auto = [i[0] for i in done_auto]  # convert tuple to values
+    # (already screened pmids are excluded in SQL, see new_rcts_query/drop_screened)
 
     # same way to retrieve the data as before
+    watermark = None
+    if revmeta_query.watermark_date is not None:
+        watermark = (revmeta_query.watermark_date, revmeta_query.watermark_pmid)
     return {"last_updated": last_updated,
+            "watermark": watermark,
             "keyword_filter": revmeta_query.keyword_filter,
             "revid": revid,
             "is_trained": revmeta_query.is_trained,
-            "done_manual": done_manual,
-            "done_auto": done_auto
+            "train_fingerprint": revmeta_query.train_fingerprint,
             }
 
 
-def main():
-    # *** main loop ***
-
-    # this works the second screener.robotreviewer.net needs some tweaking
-    # tmp testing url screener_url = "http://summarization.robotreviewer.net:7777/"
-    #screener_url = 'screen.robotreviewer.net'
-    headers = {'Content-Type': 'application/json',
-               'Accept': 'application/json'}
-    print("test-keyboarddd malfucntioon")
-    revids_to_update_ = engine.execute(
-        "select revid from revmeta where not revid='covax' ;").fetchall()
-    revids_to_update = [i.revid for i in revids_to_update_]
-
-    for revid in revids_to_update:
-
-        # get baseline data
-
+def get_training_data(revid, with_manscreen=False) -> list:
+    """
+    the labelled articles the screener model of a review is trained on: the
+    published screening decisions uploaded by the authors, and with
+    with_manscreen the decisions made on the living review since (these
+    win for a pmid in both)
+    """
+    print(
+        f"Fetching manually labelled studies from publication version {revid} ")
+    articles = engine.execute(
+        "SELECT pmid, ti, ab, decision FROM init_screen where revid = (%s)", (revid,)).fetchall()
+
+    print(f"Preparing data for RoboScreener format {revid} ")
+    # need to name it 'abs' as this is the way the screener eats it,
+    # decisions -> 1=include, 0=exclude
+    data = {art.pmid: {'pmid': art.pmid, 'ti': art.ti, 'abs': art.ab,
+                       'label': "1" if art.decision == "Include" else "0"} for art in articles}
+
+    if with_manscreen:
+        print(f"Fetching screening decisions made since publication {revid} ")
+        screened = engine.execute(
+            """SELECT pm.pmid, pm.ti, pm.ab, ms.decision FROM manscreen AS ms, pubmed AS pm
+               WHERE ms.revid = (%s) AND ms.decision IS NOT NULL AND pm.pmid = ms.pmid""", (revid,)).fetchall()
+        for art in screened:
+            data[art.pmid] = {'pmid': art.pmid, 'ti': art.ti, 'abs': art.ab,
+                              'label': "1" if art.decision else "0"}
+    return list(data.values())
+
+
+def training_fingerprint(data, backend) -> str:
+    # order independent hash of the (pmid, label) pairs a model is trained
+    # on, and of the screener backend which trained it
+    pairs = sorted(f"{row['pmid']}\t{row['label']}" for row in data)
+    return hashlib.sha256("\n".join([backend] + pairs).encode('utf-8')).hexdigest()
+
+
+def train_model(revid, data=None):
+    screener = get_screener()
+    if data is None:
+        data = get_training_data(revid, screener.train_on_manscreen)
+
+    # train the model
+    print(
+        f"Sending request for model training (this will take a while...) {revid} ")
+    screener.train(revid, [{'ti': row['ti'], 'abs': row['abs'], 'label': row['label']} for row in data])
+    # recorded only once the screener accepted the training set
+    update_train_fingerprint(revid, training_fingerprint(data, screener.name))
+    print(f"Model trained {revid} ")
+
+
+_train_executor = None
+
+
+def submit_training(revid, base_data):
+    """
+    starts training the screener model of a review in the background unless
+    a model was already trained on the same labelled data; returns the
+    Future of the training, None when there is nothing to train
+    """
+    global _train_executor
+    screener = get_screener()
+    data = get_training_data(revid, screener.train_on_manscreen)
+    fingerprint = training_fingerprint(data, screener.name)
+    if not screener.has_model(revid):
+        print(f"No model for this screener backend yet — we will train now for {revid} ")
+    elif base_data['is_trained']:
+        if base_data['train_fingerprint'] == fingerprint:
+            print(f"Model already trained on this data, will use that one {revid} ")
+            return None
+        if base_data['train_fingerprint'] is None:
+            # trained before fingerprints were recorded, keep using it
+            print(f"Model already trained, will use that one {revid} ")
+            update_train_fingerprint(revid, fingerprint)
+            return None
+        print(f"Labelled data changed since the model was trained, retraining {revid} ")
+    else:
+        print(f"No model has been trained — we will train now for {revid} ")
+
+    if _train_executor is None:
+        _train_executor = ThreadPoolExecutor(max_workers=TRAIN_WORKERS)
+    return _train_executor.submit(train_model, revid, data)
+
+
+def predict_batch(updates_filtered, revid) -> pd.DataFrame:
+    """
+    scores the new articles for one review, returns pmid, revid, score and
+    decision ready to save (scores come back in the order they were sent)
+    """
+    scored = updates_filtered[['pmid']].copy()
+    scored['revid'] = revid
+    if scored.shape[0] == 0:
+        scored['score'] = pd.Series(dtype=float)
+    else:
+        print(
+            f"Predicting relevance of {scored.shape[0]} articles with RoboScreener {revid} ")
+        preds = fetch_preds(get_api_json(updates_filtered), revid)
+        if len(preds['predictions']) != scored.shape[0]:
+            raise ValueError(
+                f"RoboScreener returned {len(preds['predictions'])} scores for {scored.shape[0]} articles {revid}")
+        scored['score'] = preds['predictions']
+    scored['decision'] = scored['score'] >= 0.5
+    return scored
+
+
+def save_batch(scored, revid, conn):
+    # writes on the DBAPI connection conn, the caller commits
+    if scored.shape[0] == 0:
+        return
+    print(f"Saving {scored.shape[0]} predictions back in the database {revid} ")
+    counts = copy_upsert(conn, scored, 'autoscreen')
+    print(f"autoscreen: {counts['inserted']} rows inserted, {counts['skipped']} skipped")
+
+    man = scored[scored.decision == True].drop(
+        ['decision', 'score'], axis=1)
+    man['revid'] = revid
+    man['decision'] = None
+    man['login'] = None
+    # by default new studies are included up until they are incorporated in the review
+    man['in_live_update'] = True
+
+    counts = copy_upsert(conn, man, 'manscreen')
+    print(f"manscreen: {counts['inserted']} rows inserted, {counts['skipped']} skipped")
+
+
+def run_update_pipeline(chunks, route):
+    """
+    pushes chunks of new RCTs through the filter, RoboScreener and database
+    writes at the same time; route(chunk) gives [(base_data, new articles)]
+
+    each chunk's writes for a review commit in one transaction with the
+    review's watermark moved to the chunk's last (update_date, pmid), so a
+    run stopped half way resumes after the last committed chunk
+    """
+    def filter_stage(chunk):
+        last = chunk.iloc[-1]
+        return chunk.shape[0], (last.update_date, str(last.pmid)), route(chunk)
+
+    def predict_stage(batch):
+        n_rows, last_key, routed = batch
+        return n_rows, last_key, [(base_data, predict_batch(df, base_data['revid'])) for base_data, df in routed]
+
+    started = [time.time(), 0]
+
+    def persist_stage(batch):
+        n_rows, last_key, scored = batch
+        with closing(engine.raw_connection()) as conn:
+            try:
+                for base_data, df in scored:
+                    save_batch(df, base_data['revid'], conn)
+                    update_watermark(conn, base_data['revid'], last_key)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        started[1] += 1
+        elapsed = time.time() - started[0]
+        print(f"chunk {started[1]}: {n_rows} rows in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-6):.0f} rows/s)")
+        started[0] = time.time()
+
+    return run_pipeline(chunks, filter_stage, predict_stage, persist_stage,
+                        queue_size=QUEUE_SIZE, filter_workers=FILTER_WORKERS,
+                        predict_workers=PREDICT_WORKERS, persist_workers=PERSIST_WORKERS)
+
+
+def index_reviews_by_cui(reviews) -> tuple:
+    """
+    one matcher over every distinct CUI used by the reviews, and for each
+    review the positions of its CUIs in that matcher
+    """
+    cuis = {}
+    groups_by_revid = {}
+    for base_data in reviews:
+        groups = set()
+        for i in base_data['keyword_filter']:
+            groups.add(cuis.setdefault(json.loads(i)['cui'], len(cuis)))
+        groups_by_revid[base_data['revid']] = frozenset(groups)
+    return compile_matcher([strlist_from_cui[cui] for cui in cuis]), groups_by_revid
+
+
+def route_to_reviews(updates, reviews, cui_index=None) -> dict:
+    """
+    sends each article of one shared scan to every review it belongs to
+
+    each article wanted by some review is scanned once for all the CUIs of
+    all the reviews, and a review gets it when all of its CUIs were found,
+    so a CUI used by several reviews costs the same as one used by one
+    """
+    if cui_index is None:
+        cui_index = index_reviews_by_cui(reviews)
+    matcher, groups_by_revid = cui_index
+
+    texts = updates.ti + ' ' + updates.ab
+    hits = {b['revid']: after_key(updates, start_key(b)).to_numpy(dtype=bool) for b in reviews}
+    # only scan the rows past some review's watermark
+    todo = np.logical_or.reduce(list(hits.values())) if hits else np.zeros(len(texts), dtype=bool)
+    found = [(matcher.groups_in(text) if isinstance(text, str) else set()) if wanted else None
+             for text, wanted in zip(texts, todo)]
+    for revid, groups in groups_by_revid.items():
+        hits[revid] &= np.array([f is not None and groups <= f for f in found], dtype=bool)
+
+    return {revid: updates[mask] for revid, mask in hits.items()}
+
+
+def train_review(revid):
+    """
+    trains the screener model for a review unless it is already trained on
+    the current labelled data, waiting for the training to finish
+    """
+    future = submit_training(revid, get_base_data(revid))
+    if future is not None:
+        future.result()
+
+
+def update_review(revid, train=True):
+    # get baseline data
+
+    print(f"Starting update of the {revid} review")
+    if train:
+        train_review(revid)
+    base_data = get_base_data(revid)
+
+    # use trained model to predict relevance of new articles
+
+    # get all new rcts since the lat update, a chunk at a time
+    print(
+        f"Fetching all new RCTs from Trialstreamer since last update {revid} ")
+    matcher = compile_cui_matcher(base_data['keyword_filter'])
+    n = run_update_pipeline(
+        iter_new_rcts(start_key(base_data), revid),
+        lambda chunk: [(base_data, filter_topic_all_cui(chunk, base_data['keyword_filter'], matcher))])
+
+    if n == 0:
+        print("no new trials - exiting this review")
+        return
+
+    print("Updating last_updated...")
+    update_last_updated(revid)
+    update_is_trained(revid)
+    print(f"FINISHED - ALL COMPLETE :) {revid} ")
+
+
+def train_reviews(revids):
+    """
+    submits the training each review needs; yields (revid, error) as each
+    review becomes ready, untrained reviews first and the ones being
+    trained as their training finishes, polling every TRAIN_POLL seconds
+    """
+    training = {}
+    for revid in revids:
+        try:
+            future = submit_training(revid, get_base_data(revid))
+        except Exception as e:
+            yield revid, e
+            continue
+        if future is None:
+            yield revid, None
+        else:
+            training[future] = revid
+
+    while training:
+        done, _ = wait(training, timeout=TRAIN_POLL, return_when=FIRST_COMPLETED)
+        if not done:
+            print(f"waiting for the training of {len(training)} reviews")
+        for future in done:
+            yield training.pop(future), future.exception()
+
+
+def update_reviews(revids):
+    """
+    per-review mode: reviews are updated while the models of others are
+    still training; a review whose training or update fails is reported
+    and skipped
+    """
+    failed = {}
+    for revid, error in train_reviews(revids):
+        if error is not None:
+            print(f"training failed for {revid}: {error!r}")
+            failed[revid] = error
+            continue
+        try:
+            update_review(revid, train=False)
+        except Exception as e:
+            print(f"update failed for {revid}: {e!r}")
+            failed[revid] = e
+    print(f"{len(revids) - len(failed)} of {len(revids)} reviews updated, failed: {list(failed)}")
+    return failed
+
+
+def update_all_reviews(revids):
+    """
+    multi-review mode: reads pubmed once from the oldest watermark and
+    hands every article to the reviews whose watermark and CUIs it matches
+    """
+    reviews = []
+    # the trainings run concurrently, the scan starts once they are all done
+    for revid, error in train_reviews(revids):
+        if error is not None:
+            print(f"training failed for {revid}, leaving it out: {error!r}")
+            continue
         print(f"Starting update of the {revid} review")
-        base_data = get_base_data(revid)
-
-        if not base_data['is_trained']:
-            print(
-                f"No model has been trained — we will train now for {revid} ")
-
-            # then train a model using the articles in 'done_manual' before moving on
-
-            print(
-                f"Fetching manually labelled studies from publication version {revid} ")
-            articles = engine.execute(
-                f"SELECT * FROM init_screen where revid = '{revid}'").fetchall()
-            print(revid)
+        reviews.append(get_base_data(revid))
 
-            data = []
+    if len(reviews) == 0:
+        return
 
-            print(f"Preparing data for RoboScreener format {revid} ")
+    oldest = min((start_key(b) for b in reviews), key=lambda k: (pd.Timestamp(str(k[0])), k[1]))
+    print(f"Fetching all new RCTs from Trialstreamer since {oldest} for {len(reviews)} reviews")
+    cui_index = index_reviews_by_cui(reviews)
 
-            for art in articles:
+    def route(chunk):
+        routed = route_to_reviews(chunk, reviews, cui_index)
+        return [(base_data, drop_screened(routed[base_data['revid']], base_data['revid']))
+                for base_data in reviews]
 
-                tmp = "1" if art.decision == "Include" else "0"
+    run_update_pipeline(iter_new_rcts(oldest), route)
 
-                row = {
-                    'ti': art.ti,
-                    'abs': art.ab,  # need to name it 'abs' as this is the way the screener eats it
-                    'label': tmp  # decision # decisions -> 1=include, 0=exclude
-                }
-                data.append(row)
-
-                # as test saved the payload as csv
-                #pd.DataFrame(data).to_csv("CHECK_data.csv", index=False)
-            # send to robotscreener for training
-
-            # train the model
-            print(
-                f"Sending request for model training (this will take a while...) {revid} ")
-            requests.post(
-                screener_url + f"train/{revid}", json=json.dumps({"labeled_data": data}), headers=headers)
-            # model is trained :) probably
-        else:
-            print(f"Model already trained, will use that one {revid} ")
+    for base_data in reviews:
+        print("Updating last_updated...")
+        update_last_updated(base_data['revid'])
+        update_is_trained(base_data['revid'])
+        print(f"FINISHED - ALL COMPLETE :) {base_data['revid']} ")
 
-        # use trained model to predict relevance of new articles
 
-        # get all new rcts since the lat update
-        print(
-            f"Fetching all new RCTs from Trialstreamer since last update {revid} ")
-        updates = get_new_rcts(base_data['last_updated'])
-        if updates.shape[0] == 0:
-            print("no new trials - exiting this review")
-            continue
+def main(shared_scan=False):
+    # *** main loop ***
 
-        # update to CUIs
+    # this works the second screener.robotreviewer.net needs some tweaking
+    # tmp testing url screener_url = "http://summarization.robotreviewer.net:7777/"
+    #screener_url = 'screen.robotreviewer.net'
+    ensure_update_schema()
+    revids_to_update_ = engine.execute(
+        "select revid from revmeta where not revid='covax' ;").fetchall()
+    revids_to_update = [i.revid for i in revids_to_update_]
 
-        print(f"Checking which match our cuis for {revid} ")
-        articles_cui_matching = filter_topic_all_cui(
-            updates, base_data['keyword_filter'])
-        print(
-            f"Making sure they've not already been screened manually (in the publication) {revid} ")
-        updates_filtered = filter_new(
-            articles_cui_matching, base_data['done_manual'], base_data['done_auto'])
+    if shared_scan:
+        update_all_reviews(revids_to_update)
+        return
 
-        # call the screener model
-        print(f"Preparing data for RoboScreener {revid} ")
-        articles_list = get_api_json(updates_filtered)
-        print(
-            f"Predicting relevance with RoboScreener (will take a while) {revid} ")
-        preds = fetch_preds(articles_list, revid)
-
-        # 1 for debug
-        print(f"Saving pure predictions to a csv {revid} ")
-        pd.DataFrame(preds).to_csv("pure_predictions.csv", index=False)
-
-        print(f"Saving all the relevant data back in the database {revid} ")
-        # set up table for saving in DB
-        updates_filtered.drop(['ti', 'ab'], axis=1, inplace=True)
-        print("Updates filtered...")
-        updates_filtered['revid'] = revid
-        updates_filtered['score'] = preds['predictions']
-        updates_filtered['decision'] = updates_filtered['score'] >= 0.5
-
-        # 2 for debug
-        print(f"Saving filtered predictions to a csv {revid} ")
-        pd.DataFrame(updates_filtered).to_csv(
-            "filtered_predictions.csv", index=False)
-        print("Writing debug testing files complete!")
-        print("Updating autoscreen...")
-        update_autoscreen_table(updates_filtered)
-
-        man = updates_filtered[updates_filtered.decision == True].drop(
-            ['decision', 'score'], axis=1)
-        man['revid'] = revid
-        man['decision'] = None
-        man['login'] = None
-        # by default new studies are included up until they are incorporated in the review
-        man['in_live_update'] = True
-
-        print("Updating manscreen...")
-        update_manscreen_table(man)
-        print("Updating last_updated...")
-        update_last_updated(revid)
-        update_is_trained(revid)
-        print(f"FINISHED - ALL COMPLETE :) {revid} ")
+    update_reviews(revids_to_update)
 
 
 if __name__ == '__main__':
-    main()
+    main(shared_scan='--shared-scan' in sys.argv)
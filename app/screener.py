@@ -0,0 +1,159 @@
+#
+#   screener backends: train a relevance model per review and score
+#   new articles with it
+#
+#   remote (default) is RoboScreener over http, local trains a TF-IDF +
+#   logistic regression model in process and keeps it pickled under
+#   app.DATA_ROOT/models; picked with SCREENER_BACKEND=remote|local
+#
+
+import abc
+import json
+import os
+import pickle
+import tempfile
+import threading
+
+import requests
+
+import app
+
+screener_url = 'http://screen.robotreviewer.net/'
+
+MODEL_ROOT = os.path.join(app.DATA_ROOT, 'models')
+# vocabulary size and n-grams of the local model
+MAX_FEATURES = 200000
+NGRAM_RANGE = (1, 2)
+
+HEADERS = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+# seconds to connect to RoboScreener, and to wait for a training or a
+# prediction response, so a hung call fails the update instead of stalling it
+CONNECT_TIMEOUT = 10
+TRAIN_TIMEOUT = 60 * 60
+PREDICT_TIMEOUT = 10 * 60
+
+
+class Screener(abc.ABC):
+    """
+    data is a list of {'ti', 'abs', 'label'} ('1' include, '0' exclude),
+    articles a list of {'ti', 'abs'}; predict returns {"predictions": [...]}
+    with one score in [0, 1] per article, in order
+    """
+    # part of the training fingerprint, so a model trained by one backend
+    # is not taken for one of another
+    name = None
+    # whether manscreen decisions are added to init_screen as training data
+    train_on_manscreen = False
+
+    def has_model(self, revid) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def train(self, revid, data):
+        pass
+
+    @abc.abstractmethod
+    def predict(self, revid, articles) -> dict:
+        pass
+
+
+class RemoteScreener(Screener):
+    name = 'remote'
+
+    def __init__(self, url=screener_url):
+        self.url = url
+
+    def train(self, revid, data):
+        response = requests.post(f'{self.url}train/{revid}', json=json.dumps({"labeled_data": data}), headers=HEADERS,
+                                 timeout=(CONNECT_TIMEOUT, TRAIN_TIMEOUT))
+        response.raise_for_status()
+
+    def predict(self, revid, articles) -> dict:
+        predictions = requests.post(f'{self.url}predict/{revid}', json=json.dumps(
+            {"input_citations": articles}), headers=HEADERS, timeout=(CONNECT_TIMEOUT, PREDICT_TIMEOUT))
+        return predictions.json()
+
+
+def _texts(articles) -> list:
+    return [f"{a.get('ti') or ''} {a.get('abs') or ''}" for a in articles]
+
+
+class LocalScreener(Screener):
+    name = 'local'
+    train_on_manscreen = True
+
+    def __init__(self, model_root=MODEL_ROOT):
+        self.model_root = model_root
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def model_path(self, revid) -> str:
+        return os.path.join(self.model_root, f"{revid}.pkl")
+
+    def has_model(self, revid) -> bool:
+        return os.path.exists(self.model_path(revid))
+
+    def train(self, revid, data):
+        import numpy as np
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+
+        labels = [int(row['label']) for row in data]
+        if len(set(labels)) < 2:
+            raise ValueError(f"need both included and excluded articles to train {revid}")
+        vectorizer = TfidfVectorizer(sublinear_tf=True, ngram_range=NGRAM_RANGE, max_features=MAX_FEATURES,
+                                     stop_words='english', dtype=np.float32)
+        X = vectorizer.fit_transform(_texts(data))
+        clf = LogisticRegression(class_weight='balanced', solver='liblinear')
+        clf.fit(X, labels)
+        # only what scoring needs, coef as a dense column for a sparse matvec
+        model = {"vectorizer": vectorizer,
+                 "coef": clf.coef_.ravel().astype('float32'),
+                 "intercept": float(clf.intercept_[0])}
+
+        os.makedirs(self.model_root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.model_root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.model_path(revid))
+        with self._lock:
+            self._models.pop(revid, None)
+
+    def load(self, revid) -> dict:
+        # cached per process, reloaded when the pickle is replaced
+        path = self.model_path(revid)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._models.get(revid)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+        with self._lock:
+            self._models[revid] = (mtime, model)
+        return model
+
+    def predict(self, revid, articles) -> dict:
+        from scipy.special import expit
+
+        model = self.load(revid)
+        # one sparse (articles x features) matrix times the weight vector
+        X = model["vectorizer"].transform(_texts(articles))
+        scores = expit(X @ model["coef"] + model["intercept"])
+        return {"predictions": scores.tolist()}
+
+
+_screener = None
+
+
+def get_screener() -> Screener:
+    global _screener
+    if _screener is None:
+        backend = os.environ.get('SCREENER_BACKEND', 'remote')
+        if backend == 'local':
+            _screener = LocalScreener()
+        elif backend == 'remote':
+            _screener = RemoteScreener()
+        else:
+            raise ValueError(f"unknown SCREENER_BACKEND {backend!r}")
+    return _screener
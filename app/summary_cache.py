@@ -0,0 +1,76 @@
+#
+#   persisted cache of summarizer results
+#
+#   keyed by the sha256 of everything the summarizer sees (title, existing
+#   summary, included pmids, endpoint), so refreshing a review without new
+#   evidence returns the stored summary instead of running inference again
+#
+
+import asyncio
+import hashlib
+import json
+
+from .database import engine
+
+# entries not used for this long are evicted, as are the least recently
+# used ones beyond SUMMARY_CACHE_MAX_ENTRIES
+SUMMARY_CACHE_MAX_AGE_DAYS = 90
+SUMMARY_CACHE_MAX_ENTRIES = 10000
+
+
+def summary_key(title, summary, pmids, endpoint) -> str:
+    payload = json.dumps([title or "", summary or "", sorted(str(p) for p in pmids), endpoint])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_summary(key, bind=None):
+    bind = engine if bind is None else bind
+    row = bind.execute("UPDATE summary_cache SET used_at = now() WHERE key = %s RETURNING updated_summary;", (key,)).fetchone()
+    return None if row is None else row[0]
+
+
+def put_summary(key, updated_summary, bind=None):
+    bind = engine if bind is None else bind
+    with bind.begin() as conn:
+        conn.execute("""INSERT INTO summary_cache (key, updated_summary) VALUES (%s, %s)
+                        ON CONFLICT (key) DO UPDATE SET updated_summary = excluded.updated_summary, used_at = now();""",
+                     (key, updated_summary))
+        evict(conn)
+
+
+def evict(bind=None, max_age_days=SUMMARY_CACHE_MAX_AGE_DAYS, max_entries=SUMMARY_CACHE_MAX_ENTRIES):
+    bind = engine if bind is None else bind
+    bind.execute("DELETE FROM summary_cache WHERE used_at < now() - %s * interval '1 day';", (max_age_days,))
+    bind.execute("""DELETE FROM summary_cache WHERE key IN
+                    (SELECT key FROM summary_cache ORDER BY used_at DESC OFFSET %s);""", (max_entries,))
+
+
+def cached_summary(title, summary, pmids, endpoint, fetch, bind=None) -> str:
+    """
+    the stored updated summary for these inputs, or fetch() (which calls the
+    summarizer and returns the updated summary) on a miss
+    """
+    key = summary_key(title, summary, pmids, endpoint)
+    updated_summary = get_summary(key, bind)
+    if updated_summary is not None:
+        print(f"summary cache hit {key[:12]}")
+        return updated_summary
+    updated_summary = fetch()
+    put_summary(key, updated_summary, bind)
+    return updated_summary
+
+
+async def cached_summary_async(title, summary, pmids, endpoint, fetch, bind=None) -> str:
+    """
+    cached_summary for a coroutine function fetch, with the database work
+    on the default executor
+    """
+    loop = asyncio.get_running_loop()
+    key = summary_key(title, summary, pmids, endpoint)
+    updated_summary = await loop.run_in_executor(None, get_summary, key, bind)
+    if updated_summary is not None:
+        print(f"summary cache hit {key[:12]}")
+        return updated_summary
+    updated_summary = await fetch()
+    await loop.run_in_executor(None, put_summary, key, updated_summary, bind)
+    return updated_summary
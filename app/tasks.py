@@ -0,0 +1,142 @@
+#
+#   celery tasks for the nightly review updates
+#
+#   worker:       celery -A app.tasks worker
+#   coordinator:  python -m app.tasks [revid ...]
+#
+
+import os
+import sys
+import time
+
+from celery import Celery, chain
+
+import app
+
+# filesystem:// shares the queue between processes on one box, and any
+# amqp:// url fans the tasks out across nodes. Without CELERY_BROKER_URL
+# the tasks run eagerly, one after another in the calling process
+broker_url = os.environ.get('CELERY_BROKER_URL')
+result_backend = os.environ.get('CELERY_RESULT_BACKEND')
+EAGER = broker_url is None
+
+# run_update gives up on the reviews still running after this long
+RUN_TIMEOUT = 6 * 60 * 60
+
+celery_app = Celery('rrlive', broker=broker_url or 'memory://',
+                    backend=result_backend or ('cache+memory://' if EAGER else None))
+celery_app.conf.update(
+    task_serializer='json',
+    result_serializer='json',
+    accept_content=['json'],
+    # a review is only acknowledged once its task has finished, so a worker
+    # dying half way hands the review to another worker
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    task_always_eager=EAGER,
+)
+
+if not EAGER and broker_url.startswith('filesystem://'):
+    broker_folder = os.environ.get('CELERY_BROKER_FOLDER', os.path.join(app._ROOT, 'celery'))
+    os.makedirs(broker_folder, exist_ok=True)
+    celery_app.conf.broker_transport_options = {
+        'data_folder_in': broker_folder,
+        'data_folder_out': broker_folder,
+    }
+
+# the steps of one review's update, in the order they are chained
+STEPS = ['train', 'update', 'summary']
+
+
+@celery_app.task(name='rrlive.train_review')
+def train_review(revid):
+    from .review_update import train_review
+    train_review(revid)
+    return revid
+
+
+@celery_app.task(name='rrlive.update_review')
+def update_review(revid):
+    from .review_update import update_review
+    update_review(revid, train=False)
+    return revid
+
+
+@celery_app.task(name='rrlive.refresh_summary')
+def refresh_summary(revid):
+    from .automated_narrative_summary_update import refresh_summary
+    refresh_summary(revid)
+    return revid
+
+
+def review_chain(revid):
+    return chain(train_review.si(revid), update_review.si(revid), refresh_summary.si(revid))
+
+
+def get_revids() -> list:
+    from .database import engine
+    return [i.revid for i in engine.execute("select revid from revmeta where not revid='covax' ;").fetchall()]
+
+
+def _steps(result) -> list:
+    # a chain's AsyncResult is its last task, the earlier ones hang off .parent
+    steps = []
+    while result is not None:
+        steps.append(result)
+        result = result.parent
+    return steps[::-1]
+
+
+def run_update(revids=None, timeout=RUN_TIMEOUT, poll=5.0) -> dict:
+    """
+    queues train -> update -> summary for every review and waits for them,
+    at most timeout seconds
+
+    each review runs independently, so a slow one only holds up itself.
+    returns {revid: {"status": ..., "step": ..., "error": ...}}
+    """
+    if not EAGER and result_backend is None:
+        raise RuntimeError("CELERY_RESULT_BACKEND must be set to follow the tasks of CELERY_BROKER_URL")
+    from .database import ensure_update_schema
+    ensure_update_schema()
+    if revids is None:
+        revids = get_revids()
+    report = {}
+    pending = {}
+    for revid in revids:
+        try:
+            pending[revid] = review_chain(revid).apply_async()
+        except Exception as e:
+            # eager mode runs the chain right here and raises its first failure
+            report[revid] = {"status": "FAILURE", "step": None, "error": repr(e)}
+            print(f"FAILURE {revid} {e!r}")
+    started = time.time()
+
+    while pending:
+        for revid, result in list(pending.items()):
+            steps = _steps(result)
+            failed = next((i for i, s in enumerate(steps) if s.failed()), None)
+            if failed is not None:
+                report[revid] = {"status": "FAILURE", "step": STEPS[failed], "error": repr(steps[failed].result)}
+            elif result.successful():
+                report[revid] = {"status": "SUCCESS", "step": None, "error": None}
+            else:
+                continue
+            print(f"{report[revid]['status']} {revid} {report[revid]['error'] or ''}")
+            del pending[revid]
+
+        if not pending:
+            break
+        if timeout is not None and time.time() - started > timeout:
+            for revid in pending:
+                report[revid] = {"status": "TIMEOUT", "step": None, "error": None}
+            break
+        time.sleep(poll)
+
+    failures = [revid for revid, r in report.items() if r['status'] != 'SUCCESS']
+    print(f"{len(report) - len(failures)} of {len(report)} reviews updated, failed: {failures}")
+    return report
+
+
+if __name__ == '__main__':
+    run_update(sys.argv[1:] or None)
@@ -0,0 +1,59 @@
+#
+#   per review watermark: the (update_date, pmid) of pubmed a review has
+#   been updated up to. The update scripts scan pubmed in that order from
+#   the watermark and move it forward with each committed chunk
+#
+#   update_date is compared as a date and pmid as text, bytewise (COLLATE
+#   "C") so the order matches the python side; ensure_update_schema checks
+#   the pubmed columns have those types (pmid text or varchar)
+#
+
+import pandas as pd
+
+
+def start_key(base_data) -> tuple:
+    """
+    the (update_date, pmid) the review has been updated up to: its
+    watermark, or for a review without one everything from the day of
+    last_updated ('' sorts before any pmid)
+    """
+    if base_data.get('watermark') is not None:
+        return base_data['watermark']
+    return (base_data['last_updated'].strftime('%Y-%m-%d'), '')
+
+
+def new_rcts_query(after, revid=None, min_year=None):
+    # all RCTs after the (update_date, pmid) key `after` in scan order, and
+    # when a revid is given only those not yet in the review's
+    # manscreen/autoscreen (anti-join on the (revid, pmid) indexes, so the
+    # history never leaves the database), optionally published from min_year on
+    sql = """SELECT pmid, ti, ab, update_date FROM pubmed WHERE is_rct_balanced=true and
+              (update_date, pmid COLLATE "C") > (%(after_date)s::date, %(after_pmid)s)"""
+    params = {"after_date": str(after[0]), "after_pmid": after[1]}
+    if min_year is not None:
+        sql += " and year>=%(min_year)s"
+        params["min_year"] = min_year
+    if revid is not None:
+        sql += """ and NOT EXISTS (SELECT 1 FROM manscreen AS ms WHERE ms.revid=%(revid)s AND ms.pmid=pubmed.pmid)
+              and NOT EXISTS (SELECT 1 FROM autoscreen AS au WHERE au.revid=%(revid)s AND au.pmid=pubmed.pmid)"""
+        params["revid"] = revid
+    return sql + """ ORDER BY update_date, pmid COLLATE "C";""", params
+
+
+def update_watermark(conn, revid, key):
+    """
+    moves the review's watermark forward to key (never back), on the DBAPI
+    connection conn so it commits together with the chunk's writes
+    """
+    with conn.cursor() as cur:
+        cur.execute("""UPDATE revmeta SET watermark_date = %(date)s::date, watermark_pmid = %(pmid)s
+            WHERE revid = %(revid)s AND (watermark_date IS NULL
+                OR (watermark_date, watermark_pmid COLLATE "C") < (%(date)s::date, %(pmid)s))""",
+                    {"date": str(key[0]), "pmid": key[1], "revid": revid})
+
+
+def after_key(updates, key) -> pd.Series:
+    # same cut off as the (update_date, pmid) > key in new_rcts_query
+    dates = pd.to_datetime(updates.update_date)
+    day = pd.Timestamp(str(key[0]))
+    return (dates > day) | ((dates == day) & (updates.pmid.astype(str) > key[1]))
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from app.cui_filter import compile_matcher, is_cui, match_cui
+
+TEXTS = [
+    "",
+    "Aspirin (ASA) for secondary prevention",
+    "effect of c++ training on a.b. scores",
+    "vitamin d[3] supplementation in 2 * n patients",
+    "HbA1c lowering with SGLT2 inhibitors",
+    "no synonyms here",
+    "costs in $ and ^ powers | pipes?",
+]
+
+STRLISTS = [
+    # regex metacharacters, matched literally
+    [["(asa)"], ["c++", "a.b."]],
+    [["d[3]", "2 * n"]],
+    [["$", "^ powers"], ["| pipes?"]],
+    [["a.b"], ["a+"]],
+    # mixed case synonyms against the lowercased text
+    [["HbA1c"], ["sglt2"]],
+    [["hba1c", "SGLT2"]],
+    # overlapping synonyms, one synonym shared by two CUIs
+    [["aspirin", "asp", "pirin"], ["aspirin"]],
+    [["sglt2 inhibitors", "sglt2"], ["inhibitors"]],
+    # the empty synonym is in every text
+    [[""], ["no syn"]],
+    # an empty synonym list never matches
+    [[]],
+    [["aspirin"], []],
+    # no CUIs at all matches everything
+    [],
+]
+
+
+@pytest.mark.parametrize("strlists", STRLISTS)
+def test_match_cui_agrees_with_is_cui(strlists):
+    texts = pd.Series(TEXTS)
+    matcher = compile_matcher(strlists)
+    expected = [is_cui(text, strlists) for text in TEXTS]
+    assert match_cui(texts, matcher).tolist() == expected
+
+
+def test_match_cui_empty_text():
+    matcher = compile_matcher([["aspirin"]])
+    assert match_cui(pd.Series([""]), matcher).tolist() == [is_cui("", [["aspirin"]])] == [False]
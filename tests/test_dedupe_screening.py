@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from app import dedupe_screening
+from app.database import ensure_unique_index
+
+SCHEMA = [
+    "CREATE TABLE manscreen (revid text, pmid text, decision boolean, login text, in_live_update boolean);",
+    "CREATE TABLE autoscreen (revid text, pmid text, score float, decision boolean);",
+]
+
+MANSCREEN = [
+    # screened and also left pending: the screened row stays
+    ("r", "1", None, None), ("r", "1", True, "alice"),
+    # two different decisions: a conflict, left alone
+    ("r", "2", True, "alice"), ("r", "2", False, "init"),
+    # the same decision twice
+    ("r", "3", True, "init"), ("r", "3", True, "init"),
+    ("r", "4", None, None),
+]
+AUTOSCREEN = [("r", "1", 0.2, False), ("r", "1", 0.9, True), ("r", "2", 0.4, False)]
+
+
+@pytest.fixture
+def screen_engine(pg_engine):
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    pg_engine.execute("INSERT INTO manscreen (revid, pmid, decision, login) VALUES (%s, %s, %s, %s);", MANSCREEN)
+    pg_engine.execute("INSERT INTO autoscreen VALUES (%s, %s, %s, %s);", AUTOSCREEN)
+    return pg_engine
+
+
+def rows(engine, table, columns):
+    return [tuple(r) for r in engine.execute(f"SELECT revid, pmid, {columns} FROM {table} ORDER BY 1, 2, 3, 4;").fetchall()]
+
+
+def test_report_changes_nothing(screen_engine, capsys):
+    assert dedupe_screening.main(bind=screen_engine) is False
+    assert len(rows(screen_engine, "manscreen", "decision, login")) == len(MANSCREEN)
+    out = capsys.readouterr().out
+    assert "manscreen: 3 duplicated (revid, pmid), 3 extra rows, 1 conflicting" in out
+    assert "conflict r 2" in out
+
+
+def test_delete_keeps_decisions_and_conflicts(screen_engine):
+    assert dedupe_screening.main(delete=True, bind=screen_engine) is False
+    assert rows(screen_engine, "manscreen", "decision, login") == [
+        ("r", "1", True, "alice"), ("r", "2", False, "init"), ("r", "2", True, "alice"),
+        ("r", "3", True, "init"), ("r", "4", None, None)]
+    assert rows(screen_engine, "autoscreen", "score, decision") == [("r", "1", 0.9, True), ("r", "2", 0.4, False)]
+    # autoscreen is clean and indexed, manscreen waits for the conflict
+    with screen_engine.begin() as conn:
+        ensure_unique_index(conn, "uq_autoscreen_revid_pmid", "autoscreen")
+    with pytest.raises(RuntimeError, match="dedupe_screening"):
+        with screen_engine.begin() as conn:
+            ensure_unique_index(conn, "uq_manscreen_revid_pmid", "manscreen")
+
+    screen_engine.execute("DELETE FROM manscreen WHERE pmid = '2' AND login = 'init';")
+    assert dedupe_screening.main(delete=True, bind=screen_engine) is True
+    assert screen_engine.execute("SELECT to_regclass('uq_manscreen_revid_pmid');").scalar() is not None
+
+
+def test_unique_index_built_once_by_concurrent_starts(pg_engine):
+    pg_engine.execute(SCHEMA[1])
+    errors = []
+
+    def start():
+        try:
+            with pg_engine.begin() as conn:
+                ensure_unique_index(conn, "uq_autoscreen_revid_pmid", "autoscreen")
+        except Exception as e:
+            errors.append(e)
+
+    # all of them find no index and then queue up behind this lock
+    blocker = pg_engine.connect()
+    held = blocker.begin()
+    blocker.execute("LOCK TABLE autoscreen IN SHARE ROW EXCLUSIVE MODE;")
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(0.5)
+    held.rollback()
+    blocker.close()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert pg_engine.execute("SELECT to_regclass('uq_autoscreen_revid_pmid');").scalar() is not None
@@ -0,0 +1,41 @@
+from contextlib import closing
+
+import pytest
+
+from app.api import storage
+
+CSV = """pmid,ti,ab,decision
+1,a title,,Include
+2,,an abstract,Exclude
+"""
+
+
+@pytest.fixture
+def crud(tmp_path, monkeypatch):
+    crud = pytest.importorskip("app.api.crud")
+    monkeypatch.setattr(storage, "_storage", storage.LocalStorage(str(tmp_path)))
+    return crud
+
+
+def write_csv(tmp_path, text):
+    path = tmp_path / "upload.csv"
+    path.write_text(text)
+    return str(path)
+
+
+def test_empty_fields_copied_as_empty_strings(crud, pg_engine, tmp_path):
+    pg_engine.execute("CREATE TABLE init_screen (id serial, revid text, pmid text, ti text, ab text, decision text);")
+    with closing(pg_engine.raw_connection()) as conn:
+        with conn.cursor() as cur:
+            for chunk in crud.read_init_screen_csv(write_csv(tmp_path, CSV), "r"):
+                crud.copy_into(cur, chunk, 'init_screen', not_null=crud.INIT_SCREEN_COLUMNS)
+        conn.commit()
+    rows = pg_engine.execute("SELECT revid, pmid, ti, ab, decision FROM init_screen ORDER BY pmid;").fetchall()
+    assert [tuple(r) for r in rows] == [("r", "1", "a title", "", "Include"), ("r", "2", "", "an abstract", "Exclude")]
+
+
+@pytest.mark.parametrize("decision", ["include", "", "Maybe"])
+def test_unknown_decisions_rejected(crud, tmp_path, decision):
+    path = write_csv(tmp_path, CSV + f"3,t,a,{decision}\n")
+    with pytest.raises(ValueError, match=r"lines \[4\]"):
+        list(crud.read_init_screen_csv(path, "r"))
@@ -0,0 +1,18 @@
+import threading
+
+from app.api.jobs import JobRegistry
+
+
+def test_job_only_visible_to_owners():
+    registry = JobRegistry(workers=1)
+    release = threading.Event()
+    job = registry.submit("slow", lambda job: release.wait(5), key="k", owner=1)
+    # a second request for the same work joins the running job
+    assert registry.submit("slow", lambda job: None, key="k", owner=2) is job
+    release.set()
+
+    assert registry.get(job.id, owner=1) is job
+    assert registry.get(job.id, owner=2) is job
+    assert registry.get(job.id, owner=3) is None
+    assert registry.get(job.id) is None
+    assert registry.get("no-such-job", owner=1) is None
@@ -0,0 +1,51 @@
+import pytest
+
+from app.api import crud
+
+
+class FakeQuery:
+
+    def __init__(self, db):
+        self.db = db
+
+    def filter_by(self, login):
+        return self
+
+    def all(self):
+        self.db.queries += 1
+        return []
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, model):
+        return FakeQuery(self)
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    crud.permission_cache.clear()
+    crud.permission_refreshed.clear()
+    yield
+    crud.permission_cache.clear()
+    crud.permission_refreshed.clear()
+
+
+def test_refresh_is_rate_limited():
+    db = FakeSession()
+    for _ in range(10):
+        # what update_abstract does for a review the user has no permission on
+        assert "r1" not in crud.get_user_revids(db, "someone")
+        assert "r1" not in crud.get_user_revids(db, "someone", refresh=True)
+    assert db.queries == 1
+
+
+def test_refresh_after_interval():
+    db = FakeSession()
+    crud.get_user_revids(db, "someone")
+    crud.permission_refreshed.invalidate("someone")
+    crud.get_user_revids(db, "someone", refresh=True)
+    assert db.queries == 2
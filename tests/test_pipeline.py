@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+
+from app.pipeline import run_pipeline
+
+
+def test_stalled_batch_does_not_read_ahead():
+    n_batches = 200
+    read = []
+    release = threading.Event()
+
+    def source():
+        for i in range(n_batches):
+            read.append(i)
+            yield i
+
+    def predict(batch):
+        if batch == 0:
+            # hold the first batch until the other worker has had time to run ahead
+            assert release.wait(5)
+        return batch
+
+    persisted = []
+    threading.Timer(0.5, lambda: (persisted.append(len(read)), release.set())).start()
+    done = run_pipeline(source(), lambda b: b, predict, persisted.append,
+                        queue_size=4, filter_workers=1, predict_workers=2, persist_workers=1)
+
+    read_while_stalled = persisted.pop(0)
+    # queue_size + the filter, predict and persist workers
+    assert read_while_stalled <= 4 + 1 + 2 + 1
+    assert done == n_batches
+    assert persisted == list(range(n_batches))
+
+
+def test_parallel_persist_holds_bounded_batches():
+    # out of order persists free their batches, so only the number held at
+    # once is bounded
+    lock = threading.Lock()
+    held = [0, 0]
+    release = threading.Event()
+
+    def source():
+        for i in range(100):
+            with lock:
+                held[0] += 1
+                held[1] = max(held)
+            yield i
+
+    def persist(batch):
+        if batch == 0:
+            assert release.wait(5)
+        with lock:
+            held[0] -= 1
+
+    threading.Timer(0.5, release.set).start()
+    assert run_pipeline(source(), lambda b: b, lambda b: b, persist, queue_size=2, persist_workers=2) == 100
+    assert held[1] <= 2 + 1 + 2 + 2
+
+
+def test_errors_are_raised():
+    def predict(batch):
+        if batch == 3:
+            raise ValueError("boom")
+        return batch
+
+    with pytest.raises(ValueError, match="boom"):
+        run_pipeline(iter(range(50)), lambda b: b, predict, lambda b: None)
@@ -0,0 +1,63 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+
+from app.metrics import REQUEST_SECONDS, RequestTimingMiddleware
+
+STREAM_SECONDS = 0.3
+
+
+class SlowChunks(Response):
+    # the body in n chunks sent STREAM_SECONDS / n apart, after the headers
+    def __init__(self, n):
+        super().__init__(media_type="text/plain")
+        self.n = n
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": self.raw_headers})
+        for i in range(self.n):
+            await asyncio.sleep(STREAM_SECONDS / self.n)
+            await send({"type": "http.response.body", "body": f"{i}\n".encode(), "more_body": i < self.n - 1})
+
+
+def make_app():
+    app = FastAPI()
+
+    @app.get("/stream/{n}")
+    def stream(n: int):
+        return SlowChunks(n)
+
+    @app.get("/fails")
+    def fails():
+        raise RuntimeError("boom")
+
+    app.add_middleware(RequestTimingMiddleware)
+    return app
+
+
+def observed(route, status):
+    labels = {"method": "GET", "route": route, "status": status}
+    count = REQUEST_SECONDS.collect()[0]
+    values = {s.name: s.value for s in count.samples if s.labels == labels}
+    return values.get("rrlive_request_seconds_count", 0), values.get("rrlive_request_seconds_sum", 0)
+
+
+def test_streamed_response_timed_to_the_last_chunk():
+    client = TestClient(make_app())
+    count, total = observed("/stream/{n}", "200")
+    assert client.get("/stream/3").text == "0\n1\n2\n"
+    new_count, new_total = observed("/stream/{n}", "200")
+    assert new_count == count + 1
+    assert new_total - total >= STREAM_SECONDS * 0.9
+
+
+def test_error_and_unmatched_routes_timed():
+    client = TestClient(make_app(), raise_server_exceptions=False)
+    count, _ = observed("/fails", "500")
+    unmatched, _ = observed("unmatched", "404")
+    assert client.get("/fails").status_code == 500
+    assert client.get("/no/such/route").status_code == 404
+    assert observed("/fails", "500")[0] == count + 1
+    assert observed("unmatched", "404")[0] == unmatched + 1
@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import event
+
+SCHEMA = [
+    "CREATE TABLE revmeta (revid text PRIMARY KEY, title text, last_updated date);",
+    "CREATE TABLE permissions (id serial PRIMARY KEY, login text, revid text);",
+    "CREATE TABLE manscreen (revid text, pmid text, decision boolean);",
+    "CREATE TABLE pubmed (pmid text PRIMARY KEY, ti text, ab text);",
+    "CREATE TABLE pubmed_annotations (pmid text PRIMARY KEY);",
+]
+
+
+def add_reviews(engine, login, first, n):
+    for i in range(first, first + n):
+        revid = f"rev-{i}"
+        engine.execute("INSERT INTO revmeta VALUES (%s, %s, '2021-01-01');", (revid, f"review {i}"))
+        engine.execute("INSERT INTO permissions (login, revid) VALUES (%s, %s);", (login, revid))
+        for j in range(3):
+            pmid = f"{i}-{j}"
+            engine.execute("INSERT INTO pubmed VALUES (%s, 'ti', 'ab');", (pmid,))
+            engine.execute("INSERT INTO pubmed_annotations VALUES (%s);", (pmid,))
+            # one screened, two waiting
+            engine.execute("INSERT INTO manscreen VALUES (%s, %s, %s);", (revid, pmid, True if j == 0 else None))
+
+
+def count_statements(engine, fn) -> int:
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return len(statements)
+
+
+def test_reviewlist_query_count_does_not_grow(pg_engine):
+    crud = pytest.importorskip("app.api.crud")
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    add_reviews(pg_engine, "one", 0, 1)
+    add_reviews(pg_engine, "many", 1, 25)
+
+    counts = {}
+    for login, n in [("one", 1), ("many", 25)]:
+        result = []
+        counts[login] = count_statements(pg_engine, lambda: result.extend(crud.get_reviewlist_from_db(pg_engine, login)))
+        assert len(result) == n
+        assert all(r["num_abstracts_to_screen"] == 2 for r in result)
+
+    assert counts["one"] == counts["many"] == 1
@@ -0,0 +1,47 @@
+import datetime
+import json
+
+import pandas as pd
+
+from app import review_update
+from app.cui_filter import is_cui
+
+STRLIST_FROM_CUI = {
+    "C1": ["aspirin", "asa"],
+    "C2": ["stroke", "cerebrovascular"],
+    "C3": ["diabetes", "hba1c"],
+}
+
+UPDATES = pd.DataFrame({
+    "pmid": ["1", "2", "3", "4", "5"],
+    "ti": ["Aspirin after stroke", "ASA in diabetes", "HbA1c targets", "cerebrovascular events", None],
+    "ab": ["trial", "and stroke", "with aspirin", "on asa", "aspirin stroke"],
+    "update_date": [datetime.date(2021, 1, 2)] * 5,
+})
+
+
+def review(revid, cuis):
+    return {"revid": revid, "keyword_filter": [json.dumps({"cui": c}) for c in cuis],
+            "watermark": None, "last_updated": datetime.date(2021, 1, 1)}
+
+
+def test_route_agrees_with_is_cui(monkeypatch):
+    monkeypatch.setattr(review_update, "strlist_from_cui", STRLIST_FROM_CUI)
+    reviews = [review("r1", ["C1", "C2"]), review("r2", ["C1"]), review("r3", ["C3", "C1"]), review("r4", [])]
+    routed = review_update.route_to_reviews(UPDATES, reviews)
+
+    texts = UPDATES.ti + ' ' + UPDATES.ab
+    for base_data in reviews:
+        strlists = [STRLIST_FROM_CUI[json.loads(i)["cui"]] for i in base_data["keyword_filter"]]
+        expected = [pmid for pmid, text in zip(UPDATES.pmid, texts)
+                    if isinstance(text, str) and is_cui(text, strlists) or not strlists]
+        assert list(routed[base_data["revid"]].pmid) == expected
+
+
+def test_route_respects_watermarks(monkeypatch):
+    monkeypatch.setattr(review_update, "strlist_from_cui", STRLIST_FROM_CUI)
+    late = review("late", ["C1"])
+    late["watermark"] = (datetime.date(2021, 1, 2), "2")
+    routed = review_update.route_to_reviews(UPDATES, [late])
+    # 5 has no title, so no text to match
+    assert list(routed["late"].pmid) == ["3", "4"]
@@ -0,0 +1,29 @@
+import pytest
+
+from app.review_update import training_fingerprint
+from app.screener import LocalScreener, RemoteScreener, Screener
+
+DATA = [{"pmid": "1", "label": "1"}, {"pmid": "2", "label": "0"}, {"pmid": "3", "label": "0"}]
+
+
+def test_fingerprint_is_order_independent():
+    assert training_fingerprint(DATA, "local") == training_fingerprint(DATA[::-1], "local")
+
+
+def test_fingerprint_changes_with_labels():
+    relabelled = [dict(DATA[0], label="0")] + DATA[1:]
+    assert training_fingerprint(DATA, "local") != training_fingerprint(relabelled, "local")
+
+
+def test_fingerprint_changes_with_backend():
+    # a model trained by one backend must not count as trained for another
+    assert training_fingerprint(DATA, LocalScreener.name) != training_fingerprint(DATA, RemoteScreener.name)
+
+
+def test_screener_needs_train_and_predict():
+    class Incomplete(Screener):
+        def train(self, revid, data):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
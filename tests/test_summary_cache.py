@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.summary_cache import cached_summary, cached_summary_async
+
+SCHEMA = [
+    """CREATE TABLE summary_cache (key text PRIMARY KEY, updated_summary text NOT NULL,
+       created_at timestamptz NOT NULL DEFAULT now(), used_at timestamptz NOT NULL DEFAULT now());""",
+]
+
+
+@pytest.fixture
+def cache_engine(pg_engine):
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    return pg_engine
+
+
+def test_cached_summary_fetches_once(cache_engine):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return "updated"
+
+    args = ("title", "summary", ["2", "1"], "http://summarizer/update_summary")
+    assert cached_summary(*args, fetch, bind=cache_engine) == "updated"
+    # pmid order does not change the key
+    assert cached_summary("title", "summary", ["1", "2"], args[3], fetch, bind=cache_engine) == "updated"
+    assert len(calls) == 1
+    cached_summary("title", "summary", ["1", "2", "3"], args[3], fetch, bind=cache_engine)
+    assert len(calls) == 2
+
+
+def test_cached_summary_async_shares_entries(cache_engine):
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return "updated async"
+
+    args = ("title", "summary", ["1"], "http://summarizer/update_summary_from_diff")
+    assert cached_summary(*args, lambda: "updated sync", bind=cache_engine) == "updated sync"
+    assert asyncio.run(cached_summary_async(*args, fetch, bind=cache_engine)) == "updated sync"
+    assert calls == []
+    assert asyncio.run(cached_summary_async("other", *args[1:], fetch, bind=cache_engine)) == "updated async"
+    assert calls == [1]
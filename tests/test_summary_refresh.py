@@ -0,0 +1,39 @@
+from app import automated_narrative_summary_update as summary_update
+
+SCHEMA = [
+    "CREATE TABLE pubmed (pmid text PRIMARY KEY, ti text, ab text);",
+    "CREATE TABLE manscreen (revid text, pmid text, decision boolean);",
+    "CREATE TABLE revmeta (revid text PRIMARY KEY, title text, summary_update_needed boolean);",
+    "CREATE TABLE live_abstracts (revid text, section text, text text);",
+    "CREATE TABLE summary_pmids (revid text, pmid text, PRIMARY KEY (revid, pmid));",
+]
+
+
+def setup_review(pg_engine, monkeypatch):
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    monkeypatch.setattr(summary_update, "engine", pg_engine)
+    pg_engine.execute("INSERT INTO revmeta VALUES ('r', 'title', true);")
+    pg_engine.execute("""INSERT INTO live_abstracts VALUES ('r', 'conclusion', 'conclusion'),
+                         ('r', 'automated_narrative_summary', 'narrative');""")
+    for pmid in ("1", "2", "3"):
+        pg_engine.execute("INSERT INTO pubmed VALUES (%s, 'ti', 'ab');", (pmid,))
+    # 1 and 2 are in the narrative, 3 was included since
+    pg_engine.execute("INSERT INTO manscreen VALUES ('r', '1', true), ('r', '2', true), ('r', '3', true);")
+    pg_engine.execute("INSERT INTO summary_pmids VALUES ('r', '1'), ('r', '2');")
+
+
+def test_new_inclusions_folded_in(pg_engine, monkeypatch):
+    setup_review(pg_engine, monkeypatch)
+    plan = summary_update.prepare_refresh("r")
+    assert not plan["full_rebuild"]
+    assert plan["pmids"] == ["3"]
+
+
+def test_excluded_study_rebuilds_the_narrative(pg_engine, monkeypatch):
+    setup_review(pg_engine, monkeypatch)
+    pg_engine.execute("UPDATE manscreen SET decision = false WHERE pmid = '2';")
+    plan = summary_update.prepare_refresh("r")
+    assert plan["full_rebuild"]
+    assert plan["existing_summary"] == "conclusion"
+    assert sorted(plan["pmids"]) == ["1", "3"]
@@ -0,0 +1,29 @@
+import datetime
+
+from app import covid_update, review_update
+
+SCHEMA = [
+    """CREATE TABLE pubmed (pmid text PRIMARY KEY, ti text, ab text, year integer,
+       update_date date, is_rct_balanced boolean);""",
+    "CREATE TABLE manscreen (revid text, pmid text, decision boolean);",
+    "CREATE TABLE autoscreen (revid text, pmid text, score float, decision boolean);",
+]
+
+
+def test_rerun_with_nothing_new(pg_engine, monkeypatch):
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    pg_engine.execute("INSERT INTO pubmed VALUES ('1', 'covid vaccine', 'ab', 2021, '2021-01-01', true);")
+    monkeypatch.setattr(review_update, "engine", pg_engine)
+    monkeypatch.setattr(covid_update, "engine", pg_engine)
+    # everything up to the last article is done
+    watermark = (datetime.date(2021, 1, 1), "1")
+
+    assert list(review_update.iter_new_rcts(watermark, "r")) == []
+    assert list(review_update.iter_new_rcts(watermark)) == []
+    assert list(covid_update.iter_new_rcts(watermark)) == []
+
+    def route(chunk):
+        raise AssertionError("nothing to route")
+
+    assert review_update.run_update_pipeline(review_update.iter_new_rcts(watermark, "r"), route) == 0
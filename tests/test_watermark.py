@@ -0,0 +1,93 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from app.database import check_watermark_columns, ensure_update_schema
+from app.watermark import after_key, new_rcts_query, update_watermark
+
+SCHEMA = [
+    """CREATE TABLE pubmed (pmid text PRIMARY KEY, ti text, ab text, year integer,
+       update_date date, is_rct_balanced boolean);""",
+    """CREATE TABLE revmeta (revid text PRIMARY KEY, last_updated date,
+       watermark_date date, watermark_pmid text);""",
+    "CREATE TABLE manscreen (revid text, pmid text, decision boolean);",
+    "CREATE TABLE autoscreen (revid text, pmid text, score float, decision boolean);",
+]
+
+# pmids which sort differently as numbers and as text
+PMIDS = ["9", "10", "100", "11"]
+
+
+@pytest.fixture
+def wm_engine(pg_engine):
+    for ddl in SCHEMA:
+        pg_engine.execute(ddl)
+    for day in (1, 2):
+        for pmid in PMIDS:
+            pg_engine.execute("INSERT INTO pubmed VALUES (%s, 'ti', 'ab', 2021, %s, true);",
+                              (f"{day}{pmid}", datetime.date(2021, 1, day)))
+    pg_engine.execute("INSERT INTO revmeta (revid, last_updated) VALUES ('r', '2021-01-01');")
+    return pg_engine
+
+
+def test_keyset_scan_matches_after_key(wm_engine):
+    sql, params = new_rcts_query(("2000-01-01", ""))
+    everything = pd.read_sql(sql, wm_engine, params=params)
+    assert everything.shape[0] == 2 * len(PMIDS)
+    for i in range(everything.shape[0]):
+        key = (everything.update_date[i], everything.pmid[i])
+        sql, params = new_rcts_query(key)
+        rest = pd.read_sql(sql, wm_engine, params=params)
+        # the database and python agree on what comes after the key
+        assert list(rest.pmid) == list(everything.pmid[i + 1:])
+        assert list(everything.pmid[after_key(everything, key)]) == list(rest.pmid)
+
+
+def test_min_year_and_screened(wm_engine):
+    wm_engine.execute("UPDATE pubmed SET year = 2019 WHERE pmid = '19';")
+    wm_engine.execute("INSERT INTO manscreen VALUES ('r', '110', NULL);")
+    wm_engine.execute("INSERT INTO autoscreen VALUES ('r', '111', 0.1, false);")
+    sql, params = new_rcts_query(("2000-01-01", ""), "r", 2020)
+    pmids = set(pd.read_sql(sql, wm_engine, params=params).pmid)
+    assert pmids == {f"{day}{pmid}" for day in (1, 2) for pmid in PMIDS} - {"19", "110", "111"}
+
+
+def test_watermark_only_moves_forward(wm_engine):
+    def watermark():
+        return tuple(wm_engine.execute("SELECT watermark_date, watermark_pmid FROM revmeta WHERE revid = 'r';").fetchone())
+
+    conn = wm_engine.raw_connection()
+    try:
+        update_watermark(conn, "r", (datetime.date(2021, 1, 2), "29"))
+        update_watermark(conn, "r", (datetime.date(2021, 1, 2), "210"))
+        conn.commit()
+        assert watermark() == (datetime.date(2021, 1, 2), "29")
+        update_watermark(conn, "r", (datetime.date(2021, 1, 1), "9"))
+        conn.commit()
+        assert watermark() == (datetime.date(2021, 1, 2), "29")
+    finally:
+        conn.close()
+
+
+def test_check_watermark_columns(wm_engine):
+    with wm_engine.connect() as conn:
+        check_watermark_columns(conn)
+        conn.execute("ALTER TABLE pubmed ALTER COLUMN update_date TYPE timestamp;")
+        with pytest.raises(RuntimeError, match="update_date"):
+            check_watermark_columns(conn)
+        conn.execute("ALTER TABLE pubmed ALTER COLUMN update_date TYPE date;")
+        conn.execute("ALTER TABLE pubmed ALTER COLUMN pmid TYPE varchar;")
+        check_watermark_columns(conn)
+        conn.execute("ALTER TABLE pubmed ALTER COLUMN pmid TYPE bigint USING pmid::bigint;")
+        with pytest.raises(RuntimeError, match="pmid"):
+            check_watermark_columns(conn)
+
+
+def test_ensure_update_schema_builds_pubmed_index(wm_engine):
+    wm_engine.execute("CREATE TABLE permissions (login text, revid text);")
+    ensure_update_schema(wm_engine)
+    ensure_update_schema(wm_engine)
+    valid = wm_engine.execute("""SELECT indisvalid FROM pg_index
+        WHERE indexrelid = to_regclass('ix_pubmed_rct_update_date_pmid');""").scalar()
+    assert valid is True